@@ -12,12 +12,21 @@ from trytond.pool import Pool
 from gateway import (
     PaymentGateway, DefaultCheckout, PaymentGatewayCountry,
     WebSite, PaymentGatewayWebsite, PaymentGatewaySale,
+    PaymentGatewayGeneration, PaymentGatewayAvailability,
+    PaymentGatewayHealth,
 )
 from defaults import (COD, Cheque)
-from register import (Register, RegisterLog, Invoice)
+from register import (
+    Register, RegisterLog, RegisterLogArchive, RegisterAggregate, Invoice,
+)
+from export import (
+    ExportRegistersStart, ExportRegistersResult, ExportRegisters,
+)
+from i18n import preload_translations
 
 
 def register():
+    preload_translations()
     Pool.register(
         PaymentGateway,
         DefaultCheckout,
@@ -25,10 +34,21 @@ def register():
         WebSite,
         PaymentGatewayWebsite,
         PaymentGatewaySale,
+        PaymentGatewayGeneration,
+        PaymentGatewayAvailability,
+        PaymentGatewayHealth,
         COD,
         Cheque,
         Register,
         RegisterLog,
+        RegisterLogArchive,
+        RegisterAggregate,
         Invoice,
+        ExportRegistersStart,
+        ExportRegistersResult,
         type_="model", module="nereid_payment"
     )
+    Pool.register(
+        ExportRegisters,
+        type_="wizard", module="nereid_payment"
+    )
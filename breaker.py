@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+    breaker
+
+    Circuit breakers which keep the checkout away from payment gateways
+    whose provider is failing or slow.
+
+    Each worker keeps a breaker per gateway which records the outcome and
+    the latency of the recent payments. When too many of them fail the
+    breaker opens and the gateway is hidden from the available gateways.
+    Once the cooldown is over the breaker is half-open: the gateway is
+    offered again, after the healthy ones, and the next payment decides
+    whether it closes or opens again. Gateways which are closed but slower
+    than the slow call threshold are offered after the healthy ones too.
+
+    The state of the breakers is shared by the workers through the
+    `nereid.payment.gateway.health` model.
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import threading
+from collections import deque
+
+__all__ = [
+    'CLOSED', 'OPEN', 'HALF_OPEN', 'SLOW', 'CircuitBreaker', 'get_breaker',
+    'get_breakers',
+]
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+#: Not a state of the breaker but a closed breaker of a slow gateway
+SLOW = 'slow'
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of a gateway in this worker.
+
+    :param window: Number of recent payments the failure rate is computed on
+    :param min_calls: Number of payments in the window below which the
+                      breaker does not open
+    :param failure_rate: Failure rate from which the breaker opens
+    :param cooldown: Seconds the breaker stays open before it is half-open
+    :param slow_call: Latency in seconds above which a payment is counted as
+                      failed, and the gateway demoted if its average latency
+                      is above it. None to ignore the latency.
+    :param smoothing: Weight of the last payment in the moving average of
+                      the latency
+    """
+
+    def __init__(self, window=20, min_calls=10, failure_rate=0.5,
+            cooldown=60, slow_call=None, smoothing=0.2):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.cooldown = cooldown
+        self.slow_call = slow_call
+        self.smoothing = smoothing
+
+        self.outcomes = deque(maxlen=window)
+        self.latency = None
+        self.state = CLOSED
+        self.opened_at = None
+        #: Whether the state changed since it was last shared
+        self.pending = False
+        self.lock = threading.Lock()
+
+    @property
+    def calls(self):
+        "Number of payments in the window"
+        return len(self.outcomes)
+
+    @property
+    def failures(self):
+        "Number of failed payments in the window"
+        return self.outcomes.count(False)
+
+    def get_state(self, now=None):
+        """Return the state of the breaker: `closed`, `open`, `half-open`,
+        or `slow` for a closed breaker whose average latency is above the
+        slow call threshold
+        """
+        if now is None:
+            now = time.time()
+        if self.state == OPEN and now - self.opened_at >= self.cooldown:
+            return HALF_OPEN
+        if self.state == CLOSED and self.slow_call is not None and \
+                self.latency is not None and self.latency > self.slow_call:
+            return SLOW
+        return self.state
+
+    def record(self, success, latency, now=None):
+        """Record the outcome of a payment and return True if it changed the
+        state of the breaker
+
+        :param success: Whether the payment succeeded
+        :param latency: Duration of the call to the gateway in seconds
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.smoothing * (latency - self.latency)
+            if self.slow_call is not None and latency > self.slow_call:
+                success = False
+            self.outcomes.append(success)
+
+            state = self.get_state(now)
+            if state == HALF_OPEN:
+                # The payment was the probe of the half-open gateway
+                return self._set_state(CLOSED if success else OPEN, now)
+            if state in (CLOSED, SLOW) and self.calls >= self.min_calls and \
+                    self.failures >= self.failure_rate * self.calls:
+                return self._set_state(OPEN, now)
+            return False
+
+    def _set_state(self, state, now):
+        self.state = state
+        self.pending = True
+        if state == OPEN:
+            self.opened_at = now
+        else:
+            self.opened_at = None
+            self.outcomes.clear()
+        return True
+
+    def load(self, state, opened_at):
+        """Load the state shared by the other workers, unless the state of
+        this breaker changed and was not shared yet
+
+        :param state: `closed` or `open`
+        :param opened_at: Timestamp the breaker opened at, if open
+        """
+        with self.lock:
+            if self.pending:
+                return
+            if state == OPEN and opened_at is not None:
+                if self.state != OPEN or self.opened_at < opened_at:
+                    self.state, self.opened_at = OPEN, opened_at
+            elif self.state == OPEN:
+                self.state, self.opened_at = CLOSED, None
+                self.outcomes.clear()
+
+
+#: The breakers of this worker per database and gateway
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(database_name, gateway_id, **options):
+    """Return the breaker of the gateway in this worker, creating it with
+    the given options the first time.
+
+    :param database_name: Name of the database of the gateway
+    :param gateway_id: ID of the gateway
+    :param options: Keyword arguments of :class:`CircuitBreaker`
+    """
+    with _breakers_lock:
+        breakers = _breakers.setdefault(database_name, {})
+        breaker = breakers.get(gateway_id)
+        if breaker is None:
+            breaker = breakers[gateway_id] = CircuitBreaker(**options)
+        return breaker
+
+
+def get_breakers(database_name):
+    """Return a dictionary of the breakers of this worker for the gateways
+    of the database, by gateway ID
+    """
+    with _breakers_lock:
+        return dict(_breakers.get(database_name, {}))
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    commands
+
+    Command line entry points of the module, installed as console scripts.
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import sys
+from datetime import datetime
+from optparse import OptionParser
+
+
+def _get_parser(usage):
+    "Return an option parser with the options common to the commands"
+    parser = OptionParser(usage=usage)
+    parser.add_option(
+        '-c', '--config', dest='config', help='Path of the trytond config'
+    )
+    parser.add_option(
+        '-d', '--database', dest='database', help='Name of the database'
+    )
+    return parser
+
+
+def _init(options):
+    "Load the config and the pool of the database"
+    from trytond.config import CONFIG
+    CONFIG.update_etc(options.config)
+
+    from trytond.pool import Pool
+    Pool.start()
+    Pool(options.database).init()
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+def export(argv=None):
+    """Stream the payment registers to a CSV or JSON lines file for
+    reconciliation
+    """
+    parser = _get_parser('%prog -d DATABASE [options]')
+    parser.add_option('-o', '--output', dest='output',
+        help='Path of the file to write, standard output by default')
+    parser.add_option('-f', '--format', dest='format', default='csv',
+        choices=['csv', 'jsonl'], help='csv (default) or jsonl')
+    parser.add_option('--from', dest='date_from',
+        help='Only registers created on or after this date (YYYY-MM-DD)')
+    parser.add_option('--to', dest='date_to',
+        help='Only registers created before this date (YYYY-MM-DD)')
+    parser.add_option('--website', dest='websites', action='append',
+        type='int', help='ID of a website, can be repeated')
+    parser.add_option('--status', dest='statuses', action='append',
+        help='Status of the registers, can be repeated')
+    parser.add_option('--method', dest='methods', action='append',
+        help='Payment model of the registers, can be repeated')
+    parser.add_option('--checkpoint', dest='checkpoint',
+        help='File recording the progress, the export resumes from it')
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+        default=1000, help='Number of registers read at a time')
+    options, _ = parser.parse_args(argv)
+    if not options.database:
+        parser.error('The database is required')
+    _init(options)
+
+    from trytond.transaction import Transaction
+    from trytond.modules.nereid_payment.export import export_registers
+
+    if options.output:
+        # Append when resuming so that the exported rows are kept
+        fileobj = open(options.output, 'ab' if options.checkpoint else 'wb')
+    else:
+        fileobj = sys.stdout
+    try:
+        with Transaction().start(options.database, 0):
+            count = export_registers(
+                fileobj, options.format, options.checkpoint,
+                date_from=_parse_date(options.date_from),
+                date_to=_parse_date(options.date_to),
+                websites=options.websites,
+                statuses=options.statuses,
+                methods=options.methods,
+                batch_size=options.batch_size,
+            )
+    finally:
+        if fileobj is not sys.stdout:
+            fileobj.close()
+    sys.stderr.write('Exported %d registers\n' % count)
+
+
+def rebuild(argv=None):
+    "Recompute the aggregates of the payment registers from the registers"
+    parser = _get_parser('%prog -d DATABASE [options]')
+    options, _ = parser.parse_args(argv)
+    if not options.database:
+        parser.error('The database is required')
+    _init(options)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    with Transaction().start(options.database, 0):
+        Pool().get('nereid.payment.register.aggregate').rebuild()
+        Transaction().cursor.commit()
+
+
+def drain(argv=None):
+    """Apply the spooled notifications of the payment providers. The spool
+    is local to the node, so this must run on every node which serves the
+    website.
+    """
+    parser = _get_parser('%prog -d DATABASE [options]')
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+        default=500, help='Number of notifications applied at a time')
+    options, _ = parser.parse_args(argv)
+    if not options.database:
+        parser.error('The database is required')
+    _init(options)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    with Transaction().start(options.database, 0):
+        count = Pool().get('nereid.payment.gateway').drain_webhooks(
+            options.batch_size
+        )
+        Transaction().cursor.commit()
+    sys.stderr.write('Applied %d notifications\n' % count)
@@ -20,6 +20,7 @@ class COD(ModelSQL):
 
     invoice_method = 'shipment'
     shipment_method = 'order'
+    payment_capabilities = ('capture', 'capture_many')
 
     @classmethod
     def capture(cls, sale):
@@ -27,13 +28,20 @@ class COD(ModelSQL):
         In COD payment is done by cash on delivery
         Hence setting invoice method in sale to postpaid
         """
+        return cls.capture_many([sale])[0]
+
+    @classmethod
+    def capture_many(cls, sales):
+        """
+        Capture the payment of many sales with a single write
+        """
         Sale = Pool().get('sale.sale')
 
-        Sale.write([sale], {
+        Sale.write(sales, {
             'invoice_method': cls.invoice_method,
             'shipment_method': cls.shipment_method,
         })
-        return True
+        return [True] * len(sales)
 
 
 class Cheque(ModelSQL):
@@ -42,15 +50,24 @@ class Cheque(ModelSQL):
 
     invoice_method = 'order'
     shipment_method = 'invoice'
+    payment_capabilities = ('capture', 'capture_many')
 
+    @classmethod
     def capture(cls, sale):
         """
         Invoice method in sale to prepaid
         """
+        return cls.capture_many([sale])[0]
+
+    @classmethod
+    def capture_many(cls, sales):
+        """
+        Capture the payment of many sales with a single write
+        """
         Sale = Pool().get('sale.sale')
 
-        Sale.write([sale], {
+        Sale.write(sales, {
             'invoice_method': cls.invoice_method,
             'shipment_method': cls.shipment_method,
         })
-        return True
+        return [True] * len(sales)
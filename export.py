@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+    export
+
+    Streaming export of the payment registers for reconciliation.
+
+    The registers are read in batches of increasing id (keyset pagination),
+    so the memory used does not depend on the number of registers exported,
+    and the last id written is a checkpoint an interrupted export can be
+    resumed from.
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import csv
+import json
+import tempfile
+
+from sql import Literal
+
+from trytond.model import ModelView, fields
+from trytond.wizard import Wizard, StateView, Button
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = [
+    'ExportRegistersStart', 'ExportRegistersResult', 'ExportRegisters',
+    'iter_registers', 'export_registers',
+]
+
+#: The columns of the export, in order
+COLUMNS = [
+    'id', 'create_date', 'reference', 'transaction_id', 'website', 'method',
+    'payment_product', 'amount', 'currency', 'status', 'process_status',
+    'sale', 'sale_reference', 'invoices',
+]
+
+STATUSES = [
+    (None, ''),
+    ('draft', 'Draft'),
+    ('in-progress', 'In Progress'),
+    ('failed', 'Failed'),
+    ('complete', 'Complete'),
+]
+
+
+def iter_registers(date_from=None, date_to=None, websites=None,
+        statuses=None, methods=None, start_after=0, batch_size=1000):
+    """Yield the batches of registers matching the filters, in order of id.
+    Each batch is a list of dictionaries with the keys of `COLUMNS`.
+
+    :param date_from: Only registers created on or after this datetime
+    :param date_to: Only registers created before this datetime
+    :param websites: List of website IDs
+    :param statuses: List of statuses
+    :param methods: List of payment models
+    :param start_after: Only registers with an id greater than this one,
+                        which is how an export is resumed
+    :param batch_size: Number of registers read per query
+    """
+    pool = Pool()
+    Register = pool.get('nereid.payment.register')
+    Sale = pool.get('sale.sale')
+    Currency = pool.get('currency.currency')
+    Invoice = pool.get('account.invoice')
+    cursor = Transaction().cursor
+
+    register = Register.__table__()
+    sale = Sale.__table__()
+    currency = Currency.__table__()
+    invoice = Invoice.__table__()
+
+    where = Literal(True)
+    if date_from:
+        where &= (register.create_date >= date_from)
+    if date_to:
+        where &= (register.create_date < date_to)
+    if websites:
+        where &= register.website.in_(websites)
+    if statuses:
+        where &= register.status.in_(statuses)
+    if methods:
+        where &= register.method.in_(methods)
+
+    last_id = start_after
+    while True:
+        cursor.execute(*register.join(
+            sale, 'LEFT', condition=sale.id == register.sale
+        ).join(
+            currency, 'LEFT', condition=currency.id == register.currency
+        ).select(
+            register.id, register.create_date, register.reference,
+            register.transaction_id, register.website, register.method,
+            register.payment_product, register.amount, currency.code,
+            register.status, register.process_status, register.sale,
+            sale.reference,
+            where=where & (register.id > last_id),
+            order_by=register.id.asc, limit=batch_size,
+        ))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        batch = [dict(zip(COLUMNS[:-1], row)) for row in rows]
+        for row in batch:
+            row['invoices'] = []
+        by_id = dict((row['id'], row) for row in batch)
+        cursor.execute(*invoice.select(
+            invoice.nereid_payment_register, invoice.number,
+            where=invoice.nereid_payment_register.in_(by_id.keys()),
+            order_by=invoice.id.asc,
+        ))
+        for register_id, number in cursor.fetchall():
+            if number:
+                by_id[register_id]['invoices'].append(number)
+
+        yield batch
+        last_id = rows[-1][0]
+
+
+def _format_value(value):
+    "Format a value of a row as text for the export"
+    if value is None:
+        return u''
+    if isinstance(value, list):
+        return u' '.join(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return unicode(value)
+
+
+def export_registers(fileobj, format='csv', checkpoint=None, **filters):
+    """Write the registers matching the filters to the file object,
+    incrementally, and return the number of registers written.
+
+    :param fileobj: A file like object to write to
+    :param format: `csv` or `jsonl` (one JSON object per line)
+    :param checkpoint: Path of a file which records the id of the last
+                       register written. If it exists, the export resumes
+                       after that register.
+    :param filters: Keyword arguments of :func:`iter_registers`
+    """
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as checkpoint_file:
+            filters['start_after'] = int(checkpoint_file.read().strip() or 0)
+
+    writer = None
+    if format == 'csv':
+        writer = csv.writer(fileobj)
+        if not filters.get('start_after'):
+            writer.writerow(COLUMNS)
+
+    count = 0
+    for batch in iter_registers(**filters):
+        for row in batch:
+            values = [_format_value(row[column]) for column in COLUMNS]
+            if writer is not None:
+                writer.writerow([v.encode('utf-8') for v in values])
+            else:
+                fileobj.write(json.dumps(dict(zip(COLUMNS, values))) + '\n')
+        count += len(batch)
+
+        fileobj.flush()
+        if checkpoint:
+            with open(checkpoint, 'w') as checkpoint_file:
+                checkpoint_file.write(str(batch[-1]['id']))
+    return count
+
+
+class ExportRegistersStart(ModelView):
+    'Export Payment Registers'
+    __name__ = 'nereid.payment.register.export.start'
+
+    date_from = fields.DateTime('From')
+    date_to = fields.DateTime('To')
+    website = fields.Many2One('nereid.website', 'Website')
+    status = fields.Selection(STATUSES, 'Status')
+    method = fields.Char('Payment Model')
+    format = fields.Selection([
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON Lines'),
+    ], 'Format', required=True)
+
+    @staticmethod
+    def default_format():
+        return 'csv'
+
+
+class ExportRegistersResult(ModelView):
+    'Export Payment Registers'
+    __name__ = 'nereid.payment.register.export.result'
+
+    file = fields.Binary('File', readonly=True)
+
+
+class ExportRegisters(Wizard):
+    """Export the payment registers
+
+    The export is written to a temporary file on disk while the registers are
+    streamed, and only the finished file is sent to the client. Use the
+    `nereid_payment_export` command for exports too large to download.
+    """
+    __name__ = 'nereid.payment.register.export'
+
+    start = StateView(
+        'nereid.payment.register.export.start',
+        'nereid_payment.register_export_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'result', 'tryton-ok', default=True),
+        ]
+    )
+    result = StateView(
+        'nereid.payment.register.export.result',
+        'nereid_payment.register_export_result_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+        ]
+    )
+
+    def default_result(self, fields):
+        with tempfile.TemporaryFile() as fileobj:
+            export_registers(
+                fileobj, self.start.format,
+                date_from=self.start.date_from,
+                date_to=self.start.date_to,
+                websites=self.start.website and [self.start.website.id],
+                statuses=self.start.status and [self.start.status],
+                methods=self.start.method and [self.start.method],
+            )
+            fileobj.seek(0)
+            return {'file': buffer(fileobj.read())}
@@ -7,18 +7,77 @@
     :copyright: (c) 2011-2013 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
-from nereid import abort, route
+import os
+import tempfile
+import time
+import hashlib
+import logging
+import weakref
+import calendar
+import datetime
+from collections import namedtuple
+
+from sql import Literal, Null
+from sql.functions import CurrentTimestamp
+
+from nereid import abort, redirect, route
 from nereid import jsonify
 from nereid.globals import request, current_app
+from nereid.signals import request_started
+from flask import has_request_context, has_app_context
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+from trytond import backend
+
+from jobs import get_default_queue
+from instrumentation import instrumented, gateway_call
+from breaker import CLOSED, OPEN, HALF_OPEN, SLOW, get_breaker, get_breakers
+from spool import Spool
 
 __all__ = [
     'PaymentGateway', 'DefaultCheckout', 'PaymentGatewayCountry',
     'WebSite', 'PaymentGatewayWebsite', 'PaymentGatewaySale',
+    'PaymentGatewayGeneration', 'PaymentGatewayAvailability',
+    'PaymentGatewayHealth',
 ]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger('nereid.payment.gateway')
+
+#: The configuration generation last seen by this worker for each database
+_generations = {}
+
+#: When this worker last shared the health of the gateways of each database
+_health_synced = {}
+
+#: Immutable snapshot of the payment configuration of a website
+WebsitePaymentConfig = namedtuple(
+    'WebsitePaymentConfig', ['id', 'payment_mode', 'allowed_gateways']
+)
+
+#: The implementation of a gateway: its gateway model, the capabilities of
+#: the model and whether the gateway processes payments asynchronously
+GatewayImplementation = namedtuple(
+    'GatewayImplementation', ['model', 'capabilities', 'asynchronous']
+)
+
+#: The capabilities discovered on each gateway model, and the attributes
+#: they are discovered from when the model does not declare them
+_capabilities = weakref.WeakKeyDictionary()
+CAPABILITY_ATTRIBUTES = [
+    ('authorize', 'authorize'),
+    ('capture', 'capture'),
+    ('authorize_many', 'authorize_many'),
+    ('capture_many', 'capture_many'),
+    ('image', 'image'),
+    ('image', 'get_image'),
+    ('parse_notification', 'parse_notification'),
+]
+
 
 class PaymentGateway(ModelSQL, ModelView):
     "Payment Gateway"
@@ -38,12 +97,143 @@ class PaymentGateway(ModelSQL, ModelView):
     websites = fields.Many2Many('nereid.payment.gateway-nereid.website',
         'gateway', 'website', 'Websites')
     sequence = fields.Integer('Sequence', required=True, select=True)
+    asynchronous = fields.Boolean(
+        'Process Asynchronously',
+        help='Capture or authorize the payment in a job queue instead of '
+        'in the checkout request'
+    )
+
+    #: Availability index which maps (website, country, is_guest) to the
+    #: ordered list of gateway ids available for that combination
+    _available_gateways_cache = Cache(
+        'nereid.payment.gateway.available_gateways', context=False
+    )
+    #: Images of the gateways as resolved from their gateway models
+    _image_cache = Cache('nereid.payment.gateway.image', context=False)
+    #: Gateway model name and asynchronous flag of each gateway
+    _implementation_cache = Cache(
+        'nereid.payment.gateway.implementation', context=False
+    )
+    #: Payment configuration of the websites, as WebsitePaymentConfig
+    _website_config_cache = Cache(
+        'nereid.payment.gateway.website_config', context=False
+    )
 
     @classmethod
     def __setup__(cls):
         super(PaymentGateway, cls).__setup__()
         cls._order.insert(0, ('sequence', 'ASC'))
 
+    @classmethod
+    def create(cls, vlist):
+        Health = Pool().get('nereid.payment.gateway.health')
+
+        gateways = super(PaymentGateway, cls).create(vlist)
+        Health.create([{'gateway': g.id} for g in gateways])
+        cls._config_changed(map(int, gateways))
+        return gateways
+
+    @classmethod
+    def write(cls, *args):
+        super(PaymentGateway, cls).write(*args)
+        cls._config_changed([
+            g.id for gateways in args[::2] for g in gateways
+        ])
+
+    @classmethod
+    def delete(cls, gateways):
+        gateway_ids = map(int, gateways)
+        super(PaymentGateway, cls).delete(gateways)
+        cls._config_changed(gateway_ids)
+
+    @classmethod
+    def _config_changed(cls, gateway_ids=None):
+        """Called whenever the gateways or their availability (countries
+        and websites) change. Refreshes the availability table, clears the
+        caches of this worker and bumps the configuration generation so that
+        other workers clear theirs too.
+
+        :param gateway_ids: IDs of the gateways which changed. If None the
+                            whole availability table is refreshed.
+        """
+        Generation = Pool().get('nereid.payment.gateway.generation')
+        Availability = Pool().get('nereid.payment.gateway.availability')
+
+        Availability.refresh(gateway_ids)
+        cls._clear_caches()
+        Generation.bump()
+
+    @classmethod
+    def _clear_caches(cls):
+        "Clear the caches built from the gateway configuration"
+        cls._available_gateways_cache.clear()
+        cls._image_cache.clear()
+        cls._website_config_cache.clear()
+        cls._implementation_cache.clear()
+
+    @classmethod
+    def _check_generation(cls):
+        """Clear the caches of this worker if the gateway configuration was
+        changed since they were built, possibly by another worker or node.
+
+        The generation is read from the database at most once per request,
+        and on every call outside of requests.
+        """
+        Generation = Pool().get('nereid.payment.gateway.generation')
+
+        in_request = has_request_context()
+        if in_request:
+            generation = getattr(request, 'payment_gateway_generation', None)
+            if generation is not None:
+                return generation
+
+        generation = Generation.get_generation()
+        database_name = Transaction().cursor.database_name
+        if _generations.get(database_name) != generation:
+            cls._clear_caches()
+            _generations[database_name] = generation
+        if in_request:
+            request.payment_gateway_generation = generation
+        return generation
+
+    @staticmethod
+    def get_capabilities(GatewayModel):
+        """Return the capabilities of the gateway model as a frozenset of
+        `authorize`, `capture`, `image`, the batch capabilities
+        `authorize_many` and `capture_many`, and `parse_notification` for
+        the models which accept webhooks.
+
+        Gateway models are inspected once for the methods of the
+        capabilities, and may declare more with a `payment_capabilities`
+        attribute, for example those implemented by a generic method.
+        """
+        capabilities = _capabilities.get(GatewayModel)
+        if capabilities is None:
+            capabilities = frozenset(
+                capability for capability, attribute in
+                CAPABILITY_ATTRIBUTES
+                if getattr(GatewayModel, attribute, None) is not None
+            ).union(getattr(GatewayModel, 'payment_capabilities', ()))
+            _capabilities[GatewayModel] = capabilities
+        return capabilities
+
+    def get_implementation(self):
+        """Return the `GatewayImplementation` of the gateway. The gateway
+        model is looked up once per gateway until the configuration changes,
+        instead of reading the `ir.model` of the gateway on every payment.
+        """
+        self._check_generation()
+
+        cached = self._implementation_cache.get(self.id)
+        if cached is None:
+            cached = (self.model.model, bool(self.asynchronous))
+            self._implementation_cache.set(self.id, cached)
+
+        GatewayModel = Pool().get(cached[0])
+        return GatewayImplementation(
+            GatewayModel, self.get_capabilities(GatewayModel), cached[1]
+        )
+
     @staticmethod
     def default_active():
         "Sets active to True by default"
@@ -58,6 +248,35 @@ class PaymentGateway(ModelSQL, ModelView):
     def default_sequence():
         return 100
 
+    @staticmethod
+    def default_asynchronous():
+        return False
+
+    @classmethod
+    def get_website_config(cls, website=None):
+        """Return the payment configuration of the website as an immutable
+        `WebsitePaymentConfig`, loaded once per worker and refreshed when
+        the website or the gateways change.
+
+        :param website: ID or active record of the website. Defaults to the
+                        current website.
+        """
+        Website = Pool().get('nereid.website')
+
+        cls._check_generation()
+
+        if website is None:
+            website = request.nereid_website
+        config = cls._website_config_cache.get(int(website))
+        if config is None:
+            website = Website(int(website))
+            config = WebsitePaymentConfig(
+                website.id, website.payment_mode,
+                tuple(map(int, website.allowed_gateways)),
+            )
+            cls._website_config_cache.set(website.id, config)
+        return config
+
     @classmethod
     def _get_available_gateways(cls, country):
         """Return the list of tuple of available payment methods
@@ -65,38 +284,138 @@ class PaymentGateway(ModelSQL, ModelView):
 
         :param country: ID or active record of the country
         """
-        domain = [
-            ('available_countries', '=', int(country)),
-            ('websites', '=', request.nereid_website.id),
-        ]
-        if request.is_guest_user:
-            domain.append(('is_allowed_for_guest', '=', True))
+        cls._check_generation()
+
+        key = (
+            request.nereid_website.id, int(country),
+            bool(request.is_guest_user)
+        )
+        gateway_ids = cls._available_gateways_cache.get(key)
+        if gateway_ids is None:
+            availability = cls.get_availability_map(
+                [key[1]], [key[0]], guest=key[2]
+            )
+            gateway_ids = tuple(availability[key[0]][key[1]])
+            cls._available_gateways_cache.set(key, gateway_ids)
 
-        return cls.search(domain)
+        return cls.browse(cls._sort_by_health(gateway_ids))
+
+    @classmethod
+    def get_availability_map(cls, countries, websites=None, guest=None):
+        """Return the availability of gateways for many countries and
+        websites at once, fetched with a single query on the availability
+        table.
+
+        The returned value is a dictionary which maps each website id to a
+        dictionary of country id to the list of ids of the gateways available,
+        ordered by sequence.
+
+        :param countries: list of IDs or active records of countries
+        :param websites: list of IDs or active records of websites. Defaults
+                         to the current website.
+        :param guest: If True, only the gateways allowed for guests are
+                      returned. Defaults to the type of the current user.
+        """
+        Availability = Pool().get('nereid.payment.gateway.availability')
+        cursor = Transaction().cursor
+
+        if websites is None:
+            websites = [request.nereid_website.id]
+        if guest is None:
+            guest = request.is_guest_user
+        countries = map(int, countries)
+        websites = map(int, websites)
+
+        result = {}
+        for website in websites:
+            result[website] = dict((country, []) for country in countries)
+        if not countries or not websites:
+            return result
+
+        availability = Availability.__table__()
+
+        where = availability.website.in_(websites)
+        where &= availability.country.in_(countries)
+        if guest:
+            where &= (availability.guest_allowed == Literal(True))
+
+        cursor.execute(*availability.select(
+            availability.website, availability.country, availability.gateway,
+            where=where,
+            order_by=[availability.sequence.asc, availability.gateway.asc],
+        ))
+        for website, country, gateway_id in cursor.fetchall():
+            gateway_ids = result[website][country]
+            if gateway_id not in gateway_ids:
+                gateway_ids.append(gateway_id)
+        return result
 
     def get_image(self):
         """Return an image for the given gateway. The API by default looks for
-        the `get_image` method in the model of the given gateway. If there is
-        such a method, the value returned from calling that method with the
-        browse record of the method as argument is taken.
+        an `image` attribute on the model of the given gateway, which allows
+        gateway models to declare their image statically. Failing that the
+        `get_image` method of the model is called if there is one.
+
+        The image is resolved once and cached until the gateway configuration
+        changes.
         """
-        GatewayModel = Pool().get(self.model.model)
+        return self.get_images([self])[self.id]
+
+    @classmethod
+    def get_images(cls, gateways):
+        """Return a dictionary which maps the id of each of the given gateways
+        to its image. Only the images which are not cached yet are resolved
+        from the gateway models.
+        """
+        cls._check_generation()
+
+        images = {}
+        for gateway in gateways:
+            cached = cls._image_cache.get(gateway.id)
+            if cached is None:
+                cached = (gateway._resolve_image(), )
+                cls._image_cache.set(gateway.id, cached)
+            images[gateway.id] = cached[0]
+        return images
 
-        if hasattr(GatewayModel, 'get_image'):
+    def _resolve_image(self):
+        "Resolve the image from the gateway model"
+        implementation = self.get_implementation()
+        GatewayModel = implementation.model
+
+        if 'image' not in implementation.capabilities:
+            return None
+        if getattr(GatewayModel, 'image', None) is not None:
+            return GatewayModel.image
+        with gateway_call():
             return GatewayModel().get_image()
-        return None
 
     @classmethod
     @route('/_available_gateways')
+    @instrumented('get_available_gateways')
     def get_available_gateways(cls):
         """Return the JSONified list of payment gateways available
 
         This is a XHR only method
 
         If type is specified as address then an address lookup is done
+
+        The response carries a strong ETag derived from the configuration
+        generation and the lookup, and a conditional request with a matching
+        `If-None-Match` is answered with a 304. Guests which send `guest=1`
+        get publicly cacheable responses, so that shared caches key them on
+        the URL without splitting them per session, and the parameter is
+        refused with a 400 for logged in users. Other responses are private.
+        The max-age in seconds is taken from the
+        `PAYMENT_GATEWAYS_MAX_AGE` config of the application (default: 300).
         """
         Address = Pool().get('party.address')
 
+        guest = request.args.get('guest', type=int)
+        if guest is not None and bool(guest) != bool(request.is_guest_user):
+            # The URL names the type of user its cached responses are for
+            abort(400)
+
         value = request.args.get('value', 0, type=int)
         if request.values.get('type') == 'address':
             # Address lookup only when logged in
@@ -104,54 +423,759 @@ class PaymentGateway(ModelSQL, ModelView):
                 abort(403)
 
             # If not validated as user's address this could lead to
-            # exploitation by ID
-            if value not in [a.id for a in
-                    request.nereid_user.party.addresses]:
+            # exploitation by ID. The ownership check and the country are
+            # fetched in a single query instead of loading every address
+            # of the party.
+            addresses = Address.search_read([
+                ('id', '=', value),
+                ('party', '=', request.nereid_user.party.id),
+            ], limit=1, fields_names=['country'])
+            if not addresses:
                 abort(403)
 
-            address = Address(value)
-            value = address.country.id
+            value = addresses[0]['country']
+            if value is None:
+                # An address without a country has no gateways
+                return jsonify(result=[])
 
-        rv = [{
-            'id': g.id,
-            'name': g.name,
-            'image': g.get_image(),
-        } for g in cls._get_available_gateways(value)]
+        etag = cls._get_available_gateways_etag(value)
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            gateways = cls._get_available_gateways(value)
+            images = cls.get_images(gateways)
+            rv = [{
+                'id': g.id,
+                'name': g.name,
+                'image': images[g.id],
+            } for g in gateways]
+            response = jsonify(result=rv)
+
+        response.set_etag(etag)
+        if guest:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+        response.cache_control.max_age = current_app.config.get(
+            'PAYMENT_GATEWAYS_MAX_AGE', 300
+        )
+        return response
+
+    @classmethod
+    @route('/_available_gateways/map')
+    @instrumented('get_available_gateways_map')
+    def get_available_gateways_map(cls):
+        """Return the JSONified gateways available on the current website for
+        each of the countries given as `countries` arguments
+
+        This is a XHR only method
+        """
+        countries = request.args.getlist('countries', type=int)
+        availability = cls.get_availability_map(countries)[
+            request.nereid_website.id
+        ]
+        for country, gateway_ids in availability.items():
+            availability[country] = cls._sort_by_health(gateway_ids)
 
+        gateways = cls.browse(list(set(
+            gateway_id for gateway_ids in availability.values()
+            for gateway_id in gateway_ids
+        )))
+        images = cls.get_images(gateways)
+        names = dict((g.id, g.name) for g in gateways)
+
+        rv = {}
+        for country, gateway_ids in availability.iteritems():
+            rv[country] = [{
+                'id': gateway_id,
+                'name': names[gateway_id],
+                'image': images[gateway_id],
+            } for gateway_id in gateway_ids]
         return jsonify(result=rv)
 
     @classmethod
-    def process(cls, sale, payment_method_id):
+    def _get_available_gateways_etag(cls, country):
+        """Return the ETag of the list of gateways available for the given
+        country on the current website, to the current type of user.
+
+        :param country: ID or active record of the country
+        """
+        generation = cls._check_generation()
+        health = ','.join(
+            '%s=%s' % item for item in sorted(cls.get_health().items())
+        )
+        key = '%s:%s:%s:%s:%s' % (
+            generation, request.nereid_website.id, int(country),
+            bool(request.is_guest_user), health,
+        )
+        return '%s-%s' % (generation, hashlib.sha1(key).hexdigest())
+
+    @classmethod
+    @instrumented('process')
+    def process(cls, sale, payment_method_id, idempotency_key=None):
         """Begins the payment processing.
 
         Returns a response object if a redirect to third party website is
         required, else processes the payment.
 
+        If an idempotency key is given, the attempt is recorded in the
+        payment register before the sale is touched. A repeated submission
+        with the same key for the sale returns the result of the original
+        attempt if it is over, or the redirect to the provider if the
+        customer was sent there, and is refused with a 409 if it is still in
+        progress. Concurrent duplicates wait on the unique constraint of the
+        register instead of on the row of the sale, and are refused with a
+        409 once the original attempt commits: a later repeat gets its
+        result.
+
         :param sale: Browse Record of the Sale
         :param payment_method_id: ID of payment method
+        :param idempotency_key: Optional token identifying the submission
         """
         Sale = Pool().get('sale.sale')
+        Register = Pool().get('nereid.payment.register')
 
-        try_to_authorize = (
-            request.nereid_website.payment_mode == 'auth_if_available'
-        )
+        website_config = cls.get_website_config()
+
+        if idempotency_key:
+            registers = Register.search([
+                ('sale', '=', sale.id),
+                ('idempotency_key', '=', idempotency_key),
+            ], limit=1)
+            if registers:
+                return cls._replay(registers[0])
 
         payment_method = cls(payment_method_id)
-        allowed_gateways = cls._get_available_gateways(
-            sale.invoice_address.country
-        )
-        if payment_method not in allowed_gateways:
+        if payment_method.id not in website_config.allowed_gateways or \
+                payment_method not in cls._get_available_gateways(
+                    sale.invoice_address.country):
             current_app.logger.error("Payment method %s is not valid" %
                 payment_method.name)
             abort(403)
 
-        payment_method_obj = Pool().get(payment_method.model.model)
+        register = None
+        implementation = payment_method.get_implementation()
+        if idempotency_key:
+            register = cls._create_idempotent_register(
+                sale, payment_method, idempotency_key
+            )
+        elif implementation.asynchronous:
+            register, = Register.create([
+                cls._get_register_values(sale, payment_method, None)
+            ])
+
         Sale.write([sale], {'payment_method': payment_method.id})
 
-        if try_to_authorize and hasattr(payment_method_obj, 'authorize'):
-            return payment_method_obj.authorize(sale)
+        action = cls._get_action(website_config, implementation)
+        if implementation.asynchronous:
+            # The checkout goes on and the status of the payment can be
+            # polled from the payment_status route of the sale
+            cls._enqueue(register, payment_method, action)
+            return True
+
+        start = time.time()
+        try:
+            with gateway_call():
+                rv = getattr(implementation.model, action)(sale)
+        except Exception:
+            # The transaction is lost, the breaker is shared on its next sync
+            cls.record_outcome(
+                payment_method.id, False, time.time() - start, share=False
+            )
+            raise
+        cls.record_outcome(
+            payment_method.id, rv is not False, time.time() - start
+        )
+
+        if register is None:
+            return rv
+        if rv is True or rv is False:
+            # A notification of the provider may have been faster, in which
+            # case the register is left as it set it
+            Register.transition(
+                register, 'complete' if rv else 'failed',
+                'Payment %s %s' % (action, 'succeeded' if rv else 'failed')
+            )
         else:
-            return payment_method_obj.capture(sale)
+            # The provider settles the register once the customer paid on
+            # its website, until then a repeat is sent there again
+            Register.write([register], {
+                'process_status': 'redirected',
+                'redirect_url': getattr(rv, 'location', None),
+            })
+        return rv
+
+    @classmethod
+    def _replay(cls, register):
+        """Return the result of the attempt recorded in the register for a
+        repeated submission, or abort with a 409 if it is still in progress
+        """
+        if register.status == 'complete':
+            return True
+        if register.status == 'failed':
+            return False
+        if register.redirect_url:
+            return redirect(register.redirect_url)
+        abort(409)
+
+    @classmethod
+    def _create_idempotent_register(cls, sale, payment_method,
+            idempotency_key):
+        """Create and return the register of an attempt with an idempotency
+        key, or abort with a 409 if a concurrent attempt with the same key
+        committed its register first. The register of that attempt is not
+        visible to the current transaction, so its result can not be
+        returned.
+        """
+        Register = Pool().get('nereid.payment.register')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+
+        savepoint = CONFIG['db_type'] == 'postgresql'
+        if savepoint:
+            cursor.execute('SAVEPOINT idempotent_register')
+        try:
+            register, = Register.create([
+                cls._get_register_values(
+                    sale, payment_method, idempotency_key
+                )
+            ])
+        except (DatabaseIntegrityError, UserError):
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT idempotent_register')
+            abort(409)
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT idempotent_register')
+        return register
+
+    @classmethod
+    def process_many(cls, payments, website=None, guest=None):
+        """Process the payments of many sales at once, for example sales
+        imported from a marketplace.
+
+        The gateways of all the sales are validated against the availability
+        and the health of the gateways in one pass, and the sales are
+        grouped per gateway model, whose `capture_many` or `authorize_many`
+        is called once per group when the model has the capability. Other
+        models get a call per sale. A single invalid gateway, or a sale
+        whose invoice address has no country, refuses the whole batch with a
+        403. The outcomes are recorded in the circuit breakers of the
+        gateways like those of `process`.
+
+        This does not need a request context, for example in a cron, if the
+        website and the type of user are given.
+
+        :param payments: List of (sale, payment method ID) tuples
+        :param website: ID or active record of the website. Defaults to the
+                        current website.
+        :param guest: If True, only the gateways allowed for guests are
+                      valid. Defaults to the type of the current user.
+        :return: The results of the payments, in order
+        """
+        Sale = Pool().get('sale.sale')
+        Register = Pool().get('nereid.payment.register')
+
+        website_config = cls.get_website_config(website)
+        countries = set(
+            sale.invoice_address.country.id for sale, _ in payments
+            if sale.invoice_address.country
+        )
+        availability = cls.get_availability_map(
+            countries, [website_config.id], guest=guest
+        )[website_config.id]
+        for country, gateway_ids in availability.items():
+            availability[country] = cls._sort_by_health(gateway_ids)
+
+        invalid = []
+        for sale, gateway_id in payments:
+            country = sale.invoice_address.country
+            if gateway_id not in website_config.allowed_gateways or \
+                    country is None or \
+                    gateway_id not in availability[country.id]:
+                invalid.append(sale)
+        if invalid:
+            logger.error(
+                "Payment methods are not valid for sales %s" %
+                ', '.join(str(sale.id) for sale in invalid)
+            )
+            abort(403)
+
+        # Group the positions of the payments by gateway
+        by_gateway = {}
+        for index, (sale, gateway_id) in enumerate(payments):
+            by_gateway.setdefault(gateway_id, []).append(index)
+
+        results = [None] * len(payments)
+        for payment_method in cls.browse(by_gateway.keys()):
+            indexes = by_gateway[payment_method.id]
+            sales = [payments[index][0] for index in indexes]
+            Sale.write(sales, {'payment_method': payment_method.id})
+
+            implementation = payment_method.get_implementation()
+            action = cls._get_action(website_config, implementation)
+            if implementation.asynchronous:
+                registers = Register.create([
+                    cls._get_register_values(
+                        sale, payment_method, None, website_config.id
+                    ) for sale in sales
+                ])
+                for index, register in zip(indexes, registers):
+                    cls._enqueue(register, payment_method, action)
+                    results[index] = True
+                continue
+
+            GatewayModel = implementation.model
+            many = '%s_many' % action in implementation.capabilities
+            rvs = []
+            for batch in [sales] if many else [[sale] for sale in sales]:
+                start = time.time()
+                try:
+                    with gateway_call():
+                        if many:
+                            batch_rvs = getattr(
+                                GatewayModel, '%s_many' % action
+                            )(batch)
+                        else:
+                            batch_rvs = [getattr(GatewayModel, action)(
+                                batch[0]
+                            )]
+                except Exception:
+                    cls.record_outcome(
+                        payment_method.id, False, time.time() - start,
+                        share=False
+                    )
+                    raise
+                # The latency of a batch is shared by its payments
+                latency = (time.time() - start) / len(batch)
+                for rv in batch_rvs:
+                    cls.record_outcome(
+                        payment_method.id, rv is not False, latency
+                    )
+                rvs.extend(batch_rvs)
+            for index, rv in zip(indexes, rvs):
+                results[index] = rv
+        return results
+
+    @classmethod
+    def _get_action(cls, website_config, implementation):
+        """Return `authorize` if the website authorizes payments when
+        possible and the gateway can authorize, else `capture`
+        """
+        if website_config.payment_mode == 'auth_if_available' and \
+                'authorize' in implementation.capabilities:
+            return 'authorize'
+        return 'capture'
+
+    @classmethod
+    def _enqueue(cls, register, payment_method, action):
+        """Record the gateway and action of the asynchronous payment in the
+        register and queue the job which processes it
+        """
+        Register = Pool().get('nereid.payment.register')
+
+        Register.write([register], {
+            'gateway': payment_method.id,
+            'action': action,
+        })
+        cls._get_job_queue().enqueue(
+            Transaction().cursor.database_name, Transaction().user,
+            Transaction().context.copy(), register.id
+        )
+
+    @classmethod
+    def _get_job_queue(cls):
+        """Return the queue of asynchronous payment jobs. This is the
+        `PAYMENT_JOB_QUEUE` config of the application if set, else a queue
+        of threads local to the process.
+        """
+        queue = None
+        if has_app_context():
+            queue = current_app.config.get('PAYMENT_JOB_QUEUE')
+        return queue or get_default_queue()
+
+    @classmethod
+    def run_payment_job(cls, register, commit_claim=False):
+        """Run the authorization or capture of an asynchronous payment which
+        was recorded in the payment register by `process`.
+
+        The job is claimed before the gateway is called, and nothing is done
+        if it is claimed by another worker already.
+
+        :param register: Active record of the payment register
+        :param commit_claim: Commit the claim before calling the gateway, for
+                             the callers which run the job in a transaction
+                             of their own
+        """
+        Register = Pool().get('nereid.payment.register')
+
+        if register.status != 'in-progress' or not register.action:
+            return
+        if not Register.claim_job(register):
+            return
+        if commit_claim:
+            Transaction().cursor.commit()
+
+        version = register.version
+        GatewayModel = register.gateway.get_implementation().model
+        gateway_id = register.gateway.id
+        start = time.time()
+        try:
+            with gateway_call():
+                rv = getattr(GatewayModel, register.action)(register.sale)
+        except Exception as exc:
+            cls.record_outcome(gateway_id, False, time.time() - start)
+            Register.transition(
+                register, 'failed', 'Payment job failed: %s' % exc,
+                version=version
+            )
+            return
+        cls.record_outcome(gateway_id, rv is True, time.time() - start)
+        Register.transition(
+            register, 'complete' if rv is True else 'failed',
+            'Payment job %s %s' % (
+                register.action, 'succeeded' if rv is True else 'failed'
+            ), version=version
+        )
+
+    @classmethod
+    def _get_breaker(cls, gateway_id):
+        """Return the circuit breaker of the gateway in this worker. The
+        options of new breakers are read from the `PAYMENT_CIRCUIT_BREAKER`
+        config of the application, a dictionary of the keyword arguments of
+        :class:`breaker.CircuitBreaker`.
+        """
+        options = {}
+        if has_app_context():
+            options = current_app.config.get('PAYMENT_CIRCUIT_BREAKER') or {}
+        return get_breaker(
+            Transaction().cursor.database_name, gateway_id, **options
+        )
+
+    @classmethod
+    def record_outcome(cls, gateway_id, success, latency, share=True):
+        """Record the outcome and the latency of a payment in the circuit
+        breaker of the gateway, and share the state of the breaker with the
+        other workers if it changed.
+
+        :param gateway_id: ID of the gateway
+        :param success: Whether the payment succeeded
+        :param latency: Duration of the call to the gateway model in seconds
+        :param share: If False the state is only shared on the next sync,
+                      for when the current transaction will not commit
+        """
+        Health = Pool().get('nereid.payment.gateway.health')
+
+        breaker = cls._get_breaker(gateway_id)
+        if breaker.record(success, latency) and share:
+            Health.store(gateway_id, breaker)
+
+    @classmethod
+    def get_health(cls):
+        """Return a dictionary of the state of the circuit breakers which
+        are not closed, by gateway ID: `open`, `half-open` or `slow`.
+
+        The states of this worker are synced with the other workers at most
+        every `PAYMENT_HEALTH_SYNC_INTERVAL` seconds (default: 10).
+        """
+        Health = Pool().get('nereid.payment.gateway.health')
+
+        database_name = Transaction().cursor.database_name
+        interval = 10
+        if has_app_context():
+            interval = current_app.config.get(
+                'PAYMENT_HEALTH_SYNC_INTERVAL', interval
+            )
+        now = time.time()
+        if now - _health_synced.get(database_name, 0) >= interval:
+            Health.sync()
+            _health_synced[database_name] = now
+
+        states = {}
+        for gateway_id, breaker in get_breakers(database_name).iteritems():
+            state = breaker.get_state(now)
+            if state != CLOSED:
+                states[gateway_id] = state
+        return states
+
+    @classmethod
+    def _sort_by_health(cls, gateway_ids):
+        """Return the list of the given gateway IDs without the gateways
+        whose circuit breaker is open, and with the half-open and slow
+        gateways after the healthy ones. The order by sequence is kept
+        otherwise.
+        """
+        health = cls.get_health()
+        if not health:
+            return list(gateway_ids)
+        return [
+            g for g in gateway_ids if g not in health
+        ] + [
+            g for g in gateway_ids if health.get(g) in (HALF_OPEN, SLOW)
+        ]
+
+    @classmethod
+    @route('/_payment_status/<int:sale>')
+    @instrumented('payment_status')
+    def payment_status(cls, sale):
+        """Return the JSONified status of the last payment of the given sale
+        of the user, which the checkout polls for asynchronous payments.
+
+        This is a XHR only method
+        """
+        Register = Pool().get('nereid.payment.register')
+
+        registers = Register.search([
+            ('sale', '=', sale),
+            ('sale.party', '=', request.nereid_user.party.id),
+        ], order=[('id', 'DESC')], limit=1)
+        if not registers:
+            abort(404)
+        return jsonify(
+            register=registers[0].id, status=registers[0].status
+        )
+
+    @classmethod
+    @route('/_payment_webhook/<provider>', methods=['POST'])
+    @instrumented('webhook')
+    def webhook(cls, provider):
+        """Spool a notification of a payment provider and acknowledge it.
+
+        The provider is the name of the gateway model of the notification,
+        which must implement `parse_notification`. The notification is
+        appended to the spool of the node which received it, and applied to
+        the payment registers later by `drain_webhooks`, so this does not
+        query the database. The spool of each web node must be drained on
+        that node, with the `nereid_payment_drain` command. Bodies larger
+        than the `PAYMENT_WEBHOOK_MAX_SIZE` config of the application
+        (default: 65536 bytes) are refused.
+        """
+        try:
+            GatewayModel = Pool().get(provider)
+        except KeyError:
+            abort(404)
+        if 'parse_notification' not in cls.get_capabilities(GatewayModel):
+            abort(404)
+
+        max_size = current_app.config.get('PAYMENT_WEBHOOK_MAX_SIZE', 65536)
+        if request.content_length and request.content_length > max_size:
+            abort(413)
+        data = request.get_data()
+        if len(data) > max_size:
+            abort(413)
+        try:
+            body = data.decode('utf-8')
+        except UnicodeDecodeError:
+            abort(400)
+
+        cls._get_webhook_spool().append({
+            'provider': provider,
+            'received': time.time(),
+            'digest': hashlib.sha1(data).hexdigest(),
+            'content_type': request.content_type,
+            'query': request.query_string,
+            'headers': dict(
+                (key, value) for key, value in request.headers.items()
+                if key.lower() != 'cookie'
+            ),
+            'body': body,
+        })
+        return jsonify(received=True)
+
+    @classmethod
+    def _get_webhook_spool(cls, name='payment_webhooks.jsonl'):
+        """Return the spool of the webhooks of the database, which is kept
+        in the data path of trytond, or in the temporary directory if trytond
+        has no data path. The appends are synced to the disk unless the
+        `PAYMENT_WEBHOOK_FSYNC` config of the application is False.
+        """
+        fsync = True
+        if has_app_context():
+            fsync = current_app.config.get('PAYMENT_WEBHOOK_FSYNC', True)
+        return Spool(os.path.join(
+            CONFIG['data_path'] or tempfile.gettempdir(),
+            Transaction().cursor.database_name, name
+        ), fsync=fsync)
+
+    @classmethod
+    def drain_webhooks(cls, batch_size=500):
+        """Apply the spooled notifications of the payment providers to the
+        payment registers, in batches. This is called by the
+        `nereid_payment_drain` command, which must run on every web node
+        since each one spools the notifications it receives locally, and by
+        a cron which only drains the node of the Tryton cron.
+
+        Notifications delivered more than once with the same body are
+        applied once. Each batch is committed on its own, and the
+        notifications which can not be applied, or whose batch fails, are
+        moved to the `payment_webhooks.failed.jsonl` spool. A segment of the
+        spool is removed once all its batches are over.
+
+        :param batch_size: Number of notifications applied at a time
+        :return: The number of notifications applied
+        """
+        spool = cls._get_webhook_spool()
+        failed = cls._get_webhook_spool('payment_webhooks.failed.jsonl')
+
+        count, seen = 0, set()
+        for segment in spool.rotate():
+            locked = spool.lock(segment)
+            if locked is None:
+                # Drained by another process
+                continue
+            try:
+                batch = []
+                for event in spool.read(segment):
+                    key = (event.get('provider'), event.get('digest'))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    batch.append(event)
+                    if len(batch) >= batch_size:
+                        count += cls._drain_batch(batch, failed)
+                        batch = []
+                if batch:
+                    count += cls._drain_batch(batch, failed)
+                spool.remove(segment)
+            finally:
+                locked.close()
+        return count
+
+    @classmethod
+    def _drain_batch(cls, events, failed):
+        """Apply a batch of notifications and commit it. If the batch fails
+        it is rolled back and its notifications are moved to the failed
+        spool, so that the following batches are still applied.
+
+        :return: The number of notifications applied
+        """
+        cursor = Transaction().cursor
+        try:
+            count = cls._apply_webhooks(events, failed)
+        except Exception:
+            cursor.rollback()
+            logger.exception(
+                'Batch of %d notifications can not be applied' % len(events)
+            )
+            for event in events:
+                failed.append(event)
+            return 0
+        cursor.commit()
+        return count
+
+    @classmethod
+    def _apply_webhooks(cls, events, failed):
+        """Parse the notifications with the `parse_notification` of their
+        gateway model and apply them to the payment registers.
+
+        `parse_notification` is called with the spooled notification (a
+        dictionary of the provider, headers, query, body...) and returns a
+        list of payloads of `nereid.payment.register.ingest`, or None to
+        ignore the notification. The `status` of a payload which matches an
+        existing register is applied with a transition.
+
+        :param events: List of spooled notifications
+        :param failed: Spool of the notifications which can not be applied
+        :return: The number of notifications applied
+        """
+        Register = Pool().get('nereid.payment.register')
+
+        payloads, unparsed = [], []
+        for event in events:
+            try:
+                GatewayModel = Pool().get(event['provider'])
+                payloads.extend(GatewayModel.parse_notification(event) or [])
+            except Exception:
+                logger.exception(
+                    'Notification of %s can not be parsed' %
+                    event.get('provider')
+                )
+                unparsed.append(event)
+        results = Register.ingest(payloads) if payloads else []
+        for (outcome, register), payload in zip(results, payloads):
+            status = payload.get('status')
+            if outcome != 'duplicate' or not status or \
+                    status == register.status:
+                continue
+            if not Register.transition(
+                    register, status, 'Status notified by the provider'):
+                logger.warning(
+                    'Notified status %s of register %s not applied' % (
+                        status, register.id
+                    )
+                )
+        # Only once the batch is applied, since the whole batch is moved to
+        # the failed spool if it fails
+        for event in unparsed:
+            failed.append(event)
+        return len(events) - len(unparsed)
+
+    @classmethod
+    def _get_register_values(cls, sale, payment_method, idempotency_key,
+            website=None):
+        """Return the values of the payment register which records an
+        attempt to pay the sale with the payment method.
+
+        :param website: ID of the website. Defaults to the current website.
+        """
+        if website is None:
+            website = request.nereid_website.id
+        return {
+            'reference': sale.reference or str(sale.id),
+            'sale': sale.id,
+            'company': sale.company.id,
+            'website': website,
+            'method': payment_method.get_implementation().model.__name__,
+            'amount': sale.total_amount,
+            'currency': sale.currency.id,
+            'status': 'in-progress',
+            'idempotency_key': idempotency_key,
+        }
+
+
+#: The applications seen by `exempt_webhook_from_csrf`, and whether their
+#: CSRF protection exempts the webhook route
+_csrf_exempted = weakref.WeakKeyDictionary()
+
+
+def _serves_webhook(app):
+    "Return True if the module is installed in the database of the app"
+    database_name = getattr(app, 'database_name', None)
+    if not database_name:
+        return False
+    try:
+        Pool(database_name).get('nereid.payment.gateway')
+    except KeyError:
+        return False
+    return True
+
+
+@request_started.connect
+def exempt_webhook_from_csrf(app, **extra):
+    """Exempt the webhook route from the CSRF protection of the application,
+    since providers post their notifications without a CSRF token. This is
+    done on the first request of the applications whose database has this
+    module, before the protection runs. The other applications are left as
+    they are.
+
+    Flask-WTF only exempts the views of `view_functions`, and skips every
+    route which is not one of them once a view is exempted, which are all
+    the routes of the nereid models. So the protection is skipped for the
+    endpoint of the webhook route instead.
+    """
+    if app in _csrf_exempted:
+        return
+    csrf_protection = getattr(app, 'csrf_protection', None)
+    _csrf_exempted[app] = exempted = \
+        csrf_protection is not None and _serves_webhook(app)
+    if not exempted:
+        return
+    protect = csrf_protection.protect
+
+    def protect_unless_webhook():
+        if request.endpoint == 'nereid.payment.gateway.webhook':
+            return None
+        return protect()
+    csrf_protection.protect = protect_unless_webhook
 
 
 class DefaultCheckout:
@@ -171,10 +1195,50 @@ class DefaultCheckout:
         :param form: Instance of validated form
         """
         PaymentGateway = Pool().get("nereid.payment.gateway")
-        return PaymentGateway.process(sale, form.payment_method.data)
+        return PaymentGateway.process(
+            sale, form.payment_method.data,
+            request.form.get('idempotency_key')
+        )
+
+
+class GatewayConfigMixin(object):
+    """Notifies the payment gateway whenever a record of a model which
+    decides the availability of gateways is created, written or deleted.
+    """
+
+    @classmethod
+    def create(cls, vlist):
+        records = super(GatewayConfigMixin, cls).create(vlist)
+        Pool().get('nereid.payment.gateway')._config_changed(
+            list(cls._get_gateway_ids(records))
+        )
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        records = [r for records in args[::2] for r in records]
+        gateway_ids = cls._get_gateway_ids(records)
+        super(GatewayConfigMixin, cls).write(*args)
+        # The gateway of the records could have been changed too
+        gateway_ids |= cls._get_gateway_ids(cls.browse(map(int, records)))
+        Pool().get('nereid.payment.gateway')._config_changed(
+            list(gateway_ids)
+        )
 
+    @classmethod
+    def delete(cls, records):
+        gateway_ids = cls._get_gateway_ids(records)
+        super(GatewayConfigMixin, cls).delete(records)
+        Pool().get('nereid.payment.gateway')._config_changed(
+            list(gateway_ids)
+        )
+
+    @classmethod
+    def _get_gateway_ids(cls, records):
+        return set(r.gateway.id for r in records)
 
-class PaymentGatewayCountry(ModelSQL):
+
+class PaymentGatewayCountry(GatewayConfigMixin, ModelSQL):
     "Nereid Payment Country"
     __name__ = 'nereid.payment.gateway-country.country'
 
@@ -206,8 +1270,15 @@ class WebSite:
         "Set payment mode to capture by default"
         return 'capture'
 
+    @classmethod
+    def write(cls, *args):
+        super(WebSite, cls).write(*args)
+        if any('payment_mode' in values for values in args[1::2]):
+            # The availability of gateways is not affected
+            Pool().get('nereid.payment.gateway')._config_changed([])
+
 
-class PaymentGatewayWebsite(ModelSQL):
+class PaymentGatewayWebsite(GatewayConfigMixin, ModelSQL):
     'Nereid Payment Gateway Website'
     __name__ = 'nereid.payment.gateway-nereid.website'
 
@@ -226,3 +1297,283 @@ class PaymentGatewaySale:
     payment_method = fields.Many2One(
         'nereid.payment.gateway', 'Payment Method'
     )
+
+
+class PaymentGatewayGeneration(ModelSQL):
+    """Payment Gateway Configuration Generation
+
+    A single row counter which is incremented every time the configuration
+    of the payment gateways changes. Workers compare it against the
+    generation their caches were built from.
+    """
+    __name__ = 'nereid.payment.gateway.generation'
+
+    generation = fields.Integer('Generation', required=True)
+
+    @staticmethod
+    def default_generation():
+        return 0
+
+    @classmethod
+    def get_generation(cls):
+        "Return the current generation of the gateway configuration"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(
+            table.generation, order_by=table.id.asc, limit=1
+        ))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    @classmethod
+    def bump(cls):
+        """Increment the generation. The increment is done in SQL so that
+        concurrent transactions never lose an update.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        records = cls.search([], order=[('id', 'ASC')], limit=1)
+        if not records:
+            cls.create([{'generation': 1}])
+            return
+        cursor.execute(*table.update(
+            [table.generation], [table.generation + 1],
+            where=table.id == records[0].id
+        ))
+
+
+class PaymentGatewayAvailability(ModelSQL):
+    """Payment Gateway Availability
+
+    A denormalised copy of the availability of the active gateways per
+    website and country. It is maintained by the write paths of the gateways
+    and of their countries and websites, so that looking up the gateways
+    available is a single scan of its composite index.
+    """
+    __name__ = 'nereid.payment.gateway.availability'
+
+    website = fields.Many2One(
+        'nereid.website', 'Website', required=True, ondelete='CASCADE'
+    )
+    country = fields.Many2One(
+        'country.country', 'Country', required=True, ondelete='CASCADE'
+    )
+    gateway = fields.Many2One(
+        'nereid.payment.gateway', 'Gateway', required=True,
+        ondelete='CASCADE', select=True
+    )
+    guest_allowed = fields.Boolean('Guest Allowed')
+    sequence = fields.Integer('Sequence')
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(PaymentGatewayAvailability, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(
+            ['website', 'country', 'guest_allowed', 'sequence'], 'add'
+        )
+
+        # Rebuild from the gateways on every update of the module
+        cls.refresh()
+
+    @classmethod
+    def refresh(cls, gateway_ids=None):
+        """Recompute the availability of the given gateways
+
+        :param gateway_ids: List of gateway IDs. If None the availability of
+                            all the gateways is recomputed.
+        """
+        pool = Pool()
+        Gateway = pool.get('nereid.payment.gateway')
+        GatewayCountry = pool.get('nereid.payment.gateway-country.country')
+        GatewayWebsite = pool.get('nereid.payment.gateway-nereid.website')
+        cursor = Transaction().cursor
+
+        if gateway_ids is not None and not gateway_ids:
+            return
+
+        availability = cls.__table__()
+        gateway = Gateway.__table__()
+        gateway_country = GatewayCountry.__table__()
+        gateway_website = GatewayWebsite.__table__()
+
+        where = gateway.active == Literal(True)
+        if gateway_ids is None:
+            cursor.execute(*availability.delete())
+        else:
+            cursor.execute(*availability.delete(
+                where=availability.gateway.in_(gateway_ids)
+            ))
+            where &= gateway.id.in_(gateway_ids)
+
+        cursor.execute(*availability.insert(
+            columns=[
+                availability.create_uid, availability.create_date,
+                availability.website, availability.country,
+                availability.gateway, availability.guest_allowed,
+                availability.sequence,
+            ],
+            values=gateway.join(
+                gateway_country,
+                condition=gateway_country.gateway == gateway.id
+            ).join(
+                gateway_website,
+                condition=gateway_website.gateway == gateway.id
+            ).select(
+                Literal(Transaction().user), CurrentTimestamp(),
+                gateway_website.website, gateway_country.country,
+                gateway.id, gateway.is_allowed_for_guest, gateway.sequence,
+                where=where,
+            )
+        ))
+
+
+def _to_datetime(timestamp):
+    "Convert a timestamp to a naive UTC datetime"
+    if timestamp is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+
+def _to_timestamp(value):
+    "Convert a naive UTC datetime to a timestamp"
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class PaymentGatewayHealth(ModelSQL, ModelView):
+    """Payment Gateway Health
+
+    The state of the circuit breaker of each gateway, shared by the workers,
+    with the failure rate and the latency seen by the worker whose breaker
+    last changed state. The rows are only written when a state changes, so
+    the workers which sync only read them.
+    """
+    __name__ = 'nereid.payment.gateway.health'
+
+    gateway = fields.Many2One(
+        'nereid.payment.gateway', 'Gateway', required=True, readonly=True,
+        ondelete='CASCADE', select=True
+    )
+    state = fields.Selection([
+        (CLOSED, 'Closed'),
+        (OPEN, 'Open'),
+    ], 'State', required=True, readonly=True)
+    opened_at = fields.DateTime('Opened At', readonly=True)
+    calls = fields.Integer('Calls', readonly=True)
+    failures = fields.Integer('Failures', readonly=True)
+    latency = fields.Float('Latency (s)', digits=(16, 3), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PaymentGatewayHealth, cls).__setup__()
+        cls._sql_constraints += [
+            ('gateway_uniq', 'UNIQUE(gateway)',
+                'The health of a gateway must be unique'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        Gateway = Pool().get('nereid.payment.gateway')
+        cursor = Transaction().cursor
+
+        super(PaymentGatewayHealth, cls).__register__(module_name)
+
+        # The gateways created before the health was tracked
+        health = cls.__table__()
+        gateway = Gateway.__table__()
+        cursor.execute(*health.insert(
+            columns=[
+                health.create_uid, health.create_date, health.gateway,
+                health.state, health.calls, health.failures,
+            ],
+            values=gateway.join(
+                health, 'LEFT', condition=health.gateway == gateway.id
+            ).select(
+                Literal(0), CurrentTimestamp(), gateway.id, Literal(CLOSED),
+                Literal(0), Literal(0),
+                where=health.id == Null,
+            )
+        ))
+
+    @staticmethod
+    def default_state():
+        return CLOSED
+
+    @staticmethod
+    def default_calls():
+        return 0
+
+    @staticmethod
+    def default_failures():
+        return 0
+
+    @classmethod
+    def store(cls, gateway_id, breaker):
+        """Share the state of the breaker of the gateway with the other
+        workers, along with its statistics. The breaker stays pending, since
+        the current transaction may still roll back, until :meth:`sync`
+        stores it again in a transaction of its own.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        state = breaker.state
+        cursor.execute(*table.update(
+            [
+                table.state, table.opened_at, table.calls, table.failures,
+                table.latency, table.write_uid, table.write_date,
+            ], [
+                state, _to_datetime(breaker.opened_at), breaker.calls,
+                breaker.failures, breaker.latency, Transaction().user,
+                CurrentTimestamp(),
+            ],
+            where=table.gateway == gateway_id
+        ))
+
+    @classmethod
+    def sync(cls):
+        """Share the states of the breakers of this worker which changed,
+        and load the states shared by the other workers.
+
+        The changed states are written and committed in a short transaction
+        of their own, so the request paths which sync do not hold the locks
+        of the shared rows, and nothing is written when no state changed.
+        """
+        Gateway = Pool().get('nereid.payment.gateway')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        breakers = get_breakers(cursor.database_name)
+        pending = [
+            (gateway_id, breaker, breaker.state, breaker.opened_at)
+            for gateway_id, breaker in breakers.iteritems() if breaker.pending
+        ]
+        if pending:
+            with Transaction().new_cursor() as transaction:
+                for gateway_id, breaker, _, _ in pending:
+                    cls.store(gateway_id, breaker)
+                transaction.cursor.commit()
+            for gateway_id, breaker, state, opened_at in pending:
+                with breaker.lock:
+                    # Unless it changed again while it was stored
+                    if (breaker.state, breaker.opened_at) == \
+                            (state, opened_at):
+                        breaker.pending = False
+
+        cursor.execute(*table.select(
+            table.gateway, table.state, table.opened_at
+        ))
+        for gateway_id, state, opened_at in cursor.fetchall():
+            breaker = breakers.get(gateway_id)
+            if breaker is None:
+                if state != OPEN:
+                    continue
+                breaker = Gateway._get_breaker(gateway_id)
+            breaker.load(state, _to_timestamp(opened_at))
@@ -12,37 +12,102 @@
 from __future__ import absolute_import
 import os
 import logging
+import threading
 
 from babel import support
 from speaklater import is_lazy_string, make_lazy_string
 
 from trytond.transaction import Transaction
 
+I18N_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'i18n')
+
+#: Set to True to reload a catalogue when its file changes. This is meant for
+#: development and can also be enabled with the `NEREID_I18N_RELOAD`
+#: environment variable.
+reload_on_change = bool(os.environ.get('NEREID_I18N_RELOAD'))
+
 _translations = {}
+_mtimes = {}
+_lock = threading.Lock()
 logger = logging.getLogger('nereid.i18n')
 logger.setLevel(logging.DEBUG)
 
 
+def _get_mtime(language):
+    """
+    Return the modification time of the catalogue of the language or None
+    if there is no catalogue
+    """
+    try:
+        return os.path.getmtime(os.path.join(
+            I18N_DIR, language, 'LC_MESSAGES', 'messages.mo'
+        ))
+    except OSError:
+        return None
+
+
+def _load_translations(language):
+    """
+    Load the translations of the given language from the i18n directory
+    """
+    logger.debug("Load translations from %s" % I18N_DIR)
+    translations = support.Translations.load(I18N_DIR, [language])
+    # Monkey patch gettext and ngettext to appect only unicode
+    # This is required for WTForms
+    translations.gettext = translations.ugettext
+    translations.ngettext = translations.ungettext
+    return translations
+
+
+def _is_stale(language):
+    return reload_on_change and _mtimes.get(language) != _get_mtime(language)
+
+
+def get_languages():
+    """
+    Return the languages which have a catalogue in the i18n directory
+    """
+    if not os.path.isdir(I18N_DIR):
+        return []
+    return sorted(
+        language for language in os.listdir(I18N_DIR)
+        if _get_mtime(language) is not None
+    )
+
+
+def preload_translations(languages=None):
+    """
+    Load the catalogues of the given languages, by default all those of the
+    i18n directory. This is called when the module is registered in the
+    pool of a worker, so that requests never read catalogues from the disk.
+    """
+    if languages is None:
+        languages = get_languages()
+    with _lock:
+        for language in languages:
+            _mtimes[language] = _get_mtime(language)
+            _translations[language] = _load_translations(language)
+
+
 def get_translations():
     """
-    Load the translations and return a Translation object. This method is
+    Return the Translation object of the language of the transaction. The
+    catalogue is loaded only once per language and cached. This method is
     designed not to fail
     """
-    translations = support.Translations.load()
-    if not hasattr(_translations, Transaction().language):
-        i18n_dir = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), 'i18n'
-        )
-        logger.debug("Load translations from %s" % i18n_dir)
-        translations = support.Translations.load(
-            i18n_dir, [Transaction().language]
-        )
-        # Monkey patch gettext and ngettext to appect only unicode
-        # This is required for WTForms
-        translations.gettext = translations.ugettext
-        translations.ngettext = translations.ungettext
-
-    return _translations.setdefault(Transaction().language, translations)
+    language = Transaction().language
+    translations = _translations.get(language)
+    if translations is not None and not _is_stale(language):
+        return translations
+
+    with _lock:
+        # Another thread could have loaded it while waiting for the lock
+        translations = _translations.get(language)
+        if translations is None or _is_stale(language):
+            _mtimes[language] = _get_mtime(language)
+            translations = _load_translations(language)
+            _translations[language] = translations
+    return translations
 
 
 def gettext(string, **variables):
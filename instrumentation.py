@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    instrumentation
+
+    Opt-in instrumentation of the payment routes and of the processing of
+    payments. It is enabled by setting `PAYMENT_INSTRUMENTATION` to True in
+    the config of the application and records, for each instrumented call:
+
+        * the number of queries and the time spent in the database
+        * the time spent in the gateway models (capture, authorize and
+          get_image)
+        * the total latency
+        * the number of requests sent to payment providers through the
+          transport and the time spent in them
+
+    The metrics are logged on the `nereid.payment.metrics` logger and passed
+    to the `PAYMENT_METRICS_CALLBACK` of the config if there is one, as
+    `callback(name, metrics)` where metrics is a dictionary. This is where a
+    StatsD or Prometheus client can be plugged. In debug mode the metrics are
+    also sent as `X-Payment-*` headers of the response.
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import logging
+import threading
+from functools import wraps
+
+from flask import has_app_context
+from nereid.globals import current_app
+from trytond.transaction import Transaction
+
+__all__ = [
+    'QueryCounter', 'instrumented', 'gateway_call', 'record_provider_request',
+]
+
+logger = logging.getLogger('nereid.payment.metrics')
+
+_local = threading.local()
+
+
+class QueryCounter(object):
+    """Count the queries executed on the cursor of the transaction and the
+    time spent executing them
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __enter__(self):
+        self.cursor = cursor = Transaction().cursor
+        # The execute of an enclosing counter, restored on exit
+        self.previous = cursor.__dict__.get('execute')
+        execute = cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            start = time.time()
+            try:
+                return execute(*args, **kwargs)
+            finally:
+                self.count += 1
+                self.time += time.time() - start
+        cursor.execute = counting_execute
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.previous is None:
+            del self.cursor.execute
+        else:
+            self.cursor.execute = self.previous
+
+
+class gateway_call(object):
+    """Context manager which adds the time spent in its block to the gateway
+    time of the instrumented call in progress, if any.
+    """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        metrics = getattr(_local, 'metrics', None)
+        if metrics is not None:
+            metrics['gateway_time'] += time.time() - self.start
+
+
+def record_provider_request(provider, status, latency):
+    """Record a request sent to a payment provider by the transport.
+
+    The request is added to the metrics of the instrumented call in
+    progress, if any, and is passed to the `PAYMENT_METRICS_CALLBACK` as
+    `transport.<provider>` when instrumentation is enabled.
+
+    :param provider: Name of the provider
+    :param status: Status of the response, None if there was none
+    :param latency: Duration of the request in seconds
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics['provider_requests'] += 1
+        metrics['provider_time'] += latency
+
+    if not has_app_context() or \
+            not current_app.config.get('PAYMENT_INSTRUMENTATION'):
+        return
+    callback = current_app.config.get('PAYMENT_METRICS_CALLBACK')
+    if callback is not None:
+        callback('transport.%s' % provider, {
+            'status': status,
+            'total_time': latency,
+        })
+
+
+def _emit(name, metrics, rv):
+    "Log the metrics and send them to the callback and the response"
+    logger.info(
+        '%s queries=%d db_ms=%.2f gateway_ms=%.2f total_ms=%.2f' % (
+            name, metrics['queries'], metrics['db_time'] * 1000,
+            metrics['gateway_time'] * 1000, metrics['total_time'] * 1000,
+        )
+    )
+
+    callback = current_app.config.get('PAYMENT_METRICS_CALLBACK')
+    if callback is not None:
+        callback(name, metrics)
+
+    if current_app.debug and hasattr(rv, 'headers'):
+        rv.headers['X-Payment-Queries'] = str(metrics['queries'])
+        for key in ('db_time', 'gateway_time', 'total_time'):
+            header = 'X-Payment-%s' % key.replace('_', '-').title()
+            rv.headers[header] = '%.2f' % (metrics[key] * 1000)
+
+
+def instrumented(name):
+    """Decorator which records the metrics of the calls of the decorated
+    function under the given name, when instrumentation is enabled.
+
+    Calls nested in an instrumented call are accounted to the outer call.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get('PAYMENT_INSTRUMENTATION') or \
+                    getattr(_local, 'metrics', None) is not None:
+                return function(*args, **kwargs)
+
+            metrics = _local.metrics = {
+                'queries': 0,
+                'db_time': 0.0,
+                'gateway_time': 0.0,
+                'provider_requests': 0,
+                'provider_time': 0.0,
+                'total_time': 0.0,
+            }
+            start = time.time()
+            try:
+                with QueryCounter() as counter:
+                    rv = function(*args, **kwargs)
+            finally:
+                _local.metrics = None
+            metrics['total_time'] = time.time() - start
+            metrics['queries'] = counter.count
+            metrics['db_time'] = counter.time
+
+            _emit(name, metrics, rv)
+            return rv
+        return wrapper
+    return decorator
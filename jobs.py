@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+    jobs
+
+    Queues which run the capture or authorization of asynchronous payments
+    outside of the request that started them.
+
+    The job itself is always the `nereid.payment.register` record which the
+    payment left `in-progress`, so the queues only carry the id of the
+    register around.
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import logging
+import threading
+import Queue
+
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = [
+    'JobQueue', 'ImmediateJobQueue', 'DatabaseJobQueue', 'LocalJobQueue',
+    'run_job', 'get_default_queue',
+]
+
+logger = logging.getLogger('nereid.payment.jobs')
+
+
+def run_job(database_name, user, context, register_id, retries=10,
+        max_delay=5):
+    """Run the payment job of the register in a transaction of its own.
+
+    The register is created by a transaction which may not have committed
+    yet when the job starts, so a register which can not be found yet is
+    looked up again with an increasing delay, for about half a minute with
+    the defaults. A job given up on is run by the `run_pending_jobs` cron.
+
+    The job is claimed, and the claim committed, before the gateway is
+    called.
+    """
+    for attempt in xrange(retries):
+        with Transaction().start(database_name, user, context=context):
+            cursor = Transaction().cursor
+            Register = Pool().get('nereid.payment.register')
+            PaymentGateway = Pool().get('nereid.payment.gateway')
+
+            registers = Register.search([('id', '=', register_id)])
+            if registers:
+                try:
+                    PaymentGateway.run_payment_job(
+                        registers[0], commit_claim=True
+                    )
+                    cursor.commit()
+                except Exception:
+                    cursor.rollback()
+                    logger.exception(
+                        'Payment job of register %s failed' % register_id
+                    )
+                return
+        time.sleep(min(0.1 * 2 ** attempt, max_delay))
+    logger.error(
+        'Payment register %s not found, its job is left to the cron' %
+        register_id
+    )
+
+
+class JobQueue(object):
+    """Base class of the queues of payment jobs. It leaves the job in the
+    database, where the `run_pending_jobs` cron of the payment register
+    picks it up. Queues which run the jobs sooner override `enqueue`.
+    """
+
+    def enqueue(self, database_name, user, context, register_id):
+        """Queue the payment job of the register
+
+        :param database_name: Name of the database of the register
+        :param user: ID of the user to run the job as
+        :param context: The context of the transaction to run the job in
+        :param register_id: ID of the payment register
+        """
+        pass
+
+
+class ImmediateJobQueue(JobQueue):
+    """Run the job right away in the current transaction. This is an in
+    process stand-in meant for tests.
+    """
+
+    def enqueue(self, database_name, user, context, register_id):
+        Register = Pool().get('nereid.payment.register')
+        PaymentGateway = Pool().get('nereid.payment.gateway')
+
+        PaymentGateway.run_payment_job(Register(register_id))
+
+
+class DatabaseJobQueue(JobQueue):
+    """Leave the job in the database. The registers in progress are picked up
+    by the `run_pending_jobs` cron of the payment register.
+    """
+
+
+class LocalJobQueue(JobQueue):
+    """Run the jobs in a pool of threads of the current process. Jobs which
+    are queued when the process dies are left in progress in the database
+    and can be recovered with the `run_pending_jobs` cron.
+    """
+
+    def __init__(self, workers=2):
+        self.queue = Queue.Queue()
+        self.workers = workers
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        "Start the worker threads if they are not running yet"
+        with self.lock:
+            if self.threads:
+                return
+            for index in xrange(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name='payment-job-%d' % index
+                )
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        while True:
+            args = self.queue.get()
+            try:
+                run_job(*args)
+            finally:
+                self.queue.task_done()
+
+    def enqueue(self, database_name, user, context, register_id):
+        self.start()
+        self.queue.put((database_name, user, context, register_id))
+
+
+_default_queue = None
+
+
+def get_default_queue():
+    "Return the queue used when the application does not configure one"
+    global _default_queue
+    if _default_queue is None:
+        _default_queue = LocalJobQueue()
+    return _default_queue
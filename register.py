@@ -8,13 +8,32 @@
     :copyright: © 2011-2013 by Openlabs Technologies & Consulting (P) Limited
     :license: GPLv3, see LICENSE for more details.
 """
+import zlib
+import json
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal
+from itertools import groupby
+
+from sql import Literal, Null
+from sql.aggregate import Max, Sum
+
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pyson import Equal, Eval, Not
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
 
-__all__ = ['Register', 'RegisterLog', 'Invoice']
+__all__ = [
+    'Register', 'RegisterLog', 'RegisterLogArchive', 'RegisterAggregate',
+    'Invoice',
+]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger('nereid.payment.register')
+
 
 class Register(ModelSQL, ModelView):
     "Nereid Payemnt Register"
@@ -55,6 +74,437 @@ class Register(ModelSQL, ModelView):
     logs = fields.One2Many(
         'nereid.payment.register.log', 'register', 'Logs', readonly=True
     )
+    #: Token sent by the client to identify a payment submission, so that
+    #: repeated submissions of the same sale are not processed twice
+    idempotency_key = fields.Char(
+        'Idempotency Key', readonly=True, select=True
+    )
+    #: Where the customer was redirected to complete the payment on the
+    #: website of the provider, which settles the register later
+    redirect_url = fields.Char('Redirect URL', readonly=True)
+    #: The gateway and the action of an asynchronous payment job
+    gateway = fields.Many2One(
+        'nereid.payment.gateway', 'Gateway', readonly=True
+    )
+    action = fields.Selection([
+        (None, ''),
+        ('authorize', 'Authorize'),
+        ('capture', 'Capture'),
+    ], 'Action', readonly=True)
+    #: Compressed archive of the logs older than the retention period
+    log_archive = fields.Many2One(
+        'nereid.payment.register.log.archive', 'Log Archive', readonly=True
+    )
+    archived_logs = fields.Function(
+        fields.Text('Archived Logs'), 'get_archived_logs'
+    )
+    #: Incremented on every change of the status, see `transition`
+    version = fields.Integer('Version', required=True, readonly=True)
+    #: When a worker claimed the asynchronous payment job, see `claim_job`
+    job_claimed_at = fields.DateTime('Job Claimed At', readonly=True)
+
+    #: How long a claimed job may run before it is considered lost, and how
+    #: long a queued job is left to its queue before the cron runs it
+    _job_timeout = timedelta(minutes=30)
+    _job_grace = timedelta(minutes=1)
+
+    #: The statuses a register can move to from each status
+    _transitions = {
+        'draft': ('in-progress', ),
+        'in-progress': ('complete', 'failed'),
+        'complete': (),
+        'failed': (),
+    }
+
+    #: Recently looked up (method, transaction_id) pairs and their register
+    _transaction_cache = Cache(
+        'nereid.payment.register.transaction', size_limit=10240,
+        context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(Register, cls).__setup__()
+        cls._sql_constraints += [
+            ('sale_idempotency_key_uniq', 'UNIQUE(sale, idempotency_key)',
+                'The idempotency key must be unique per sale'),
+            ('method_transaction_id_uniq', 'UNIQUE(method, transaction_id)',
+                'The transaction ID must be unique per payment model'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(Register, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(['website', 'reference'], 'add')
+
+    @staticmethod
+    def default_status():
+        return 'draft'
+
+    @staticmethod
+    def default_version():
+        return 0
+
+    @classmethod
+    def create(cls, vlist):
+        Aggregate = Pool().get('nereid.payment.register.aggregate')
+
+        registers = super(Register, cls).create(vlist)
+        Aggregate.add(registers)
+        return registers
+
+    @classmethod
+    def write(cls, *args):
+        Aggregate = Pool().get('nereid.payment.register.aggregate')
+
+        aggregated = []
+        for registers, values in zip(args[::2], args[1::2]):
+            if set(values) & set(Aggregate.AGGREGATED_FIELDS):
+                aggregated.extend(map(int, registers))
+        # Browse again to subtract the values as they are in the database
+        Aggregate.add(cls.browse(aggregated), sign=-1)
+
+        super(Register, cls).write(*args)
+
+        Aggregate.add(cls.browse(aggregated))
+        for values in args[1::2]:
+            if 'method' in values or 'transaction_id' in values:
+                cls._transaction_cache.clear()
+                break
+
+        # Changes of the status which do not go through transition still
+        # invalidate the version the concurrent transitions expect
+        versioned = []
+        for registers, values in zip(args[::2], args[1::2]):
+            if 'version' not in values and \
+                    ('status' in values or 'process_status' in values):
+                versioned.extend(map(int, registers))
+        if versioned:
+            table = cls.__table__()
+            Transaction().cursor.execute(*table.update(
+                [table.version], [table.version + 1],
+                where=table.id.in_(versioned)
+            ))
+
+    @classmethod
+    def delete(cls, registers):
+        Aggregate = Pool().get('nereid.payment.register.aggregate')
+
+        Aggregate.add(cls.browse(map(int, registers)), sign=-1)
+        super(Register, cls).delete(registers)
+        cls._transaction_cache.clear()
+
+    def get_archived_logs(self, name):
+        "Return the archived log messages, oldest first, one per line"
+        if not self.log_archive:
+            return None
+        return u'\n'.join(
+            u'%s: %s' % (log['create_date'], log['message'])
+            for log in self.log_archive.get_logs()
+        )
+
+    @classmethod
+    def find_by_transaction(cls, method, transaction_id, use_cache=True):
+        """Return the register of the transaction of the payment provider or
+        None. This is meant for provider callbacks, and webhook retries of a
+        recently seen transaction are resolved from an in memory LRU cache.
+
+        :param method: The payment model of the register
+        :param transaction_id: The transaction ID of the payment provider
+        :param use_cache: If False the database is always queried
+        """
+        cursor = Transaction().cursor
+
+        key = (method, transaction_id)
+        register_id = cls._transaction_cache.get(key) if use_cache else None
+        if register_id is None:
+            table = cls.__table__()
+            where = table.method == method
+            where &= table.transaction_id == transaction_id
+            cursor.execute(*table.select(table.id, where=where, limit=1))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            register_id = row[0]
+            cls._transaction_cache.set(key, register_id)
+        return cls(register_id)
+
+    @classmethod
+    def find_by_reference(cls, website, reference):
+        """Return the latest register of the reference on the website or
+        None.
+
+        :param website: ID or active record of the website
+        :param reference: The reference sent to the payment provider
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        where = table.website == int(website)
+        where &= table.reference == reference
+        cursor.execute(*table.select(
+            table.id, where=where, order_by=table.id.desc, limit=1,
+        ))
+        row = cursor.fetchone()
+        return cls(row[0]) if row else None
+
+    @classmethod
+    def transition(cls, register, status, message=None, values=None,
+            version=None):
+        """Move the register to the given status if it is still at the
+        status and version it was read at (compare and set), and append a
+        log of the transition, in the current transaction.
+
+        Concurrent handlers of the same payment (provider notifications,
+        return URLs and reconciliation) do not wait on each other: on
+        PostgreSQL the row is locked with NOWAIT, and a register locked by
+        another transaction or changed since it was read is a conflict.
+
+        :param register: Active record of the register, as read by the
+                         caller
+        :param status: The new status
+        :param message: Message of the log, defaults to the transition
+        :param values: Other values to write with the status, for example
+                       the `process_status` or the `transaction_id`
+        :param version: The version the caller expects the register to be
+                        at. Defaults to the version of the record.
+        :return: True if the register moved to the status, False on a
+                 conflict or if the transition is not allowed
+        """
+        RegisterLog = Pool().get('nereid.payment.register.log')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        current = register.status or 'draft'
+        if version is None:
+            version = register.version
+        if status not in cls._transitions.get(current, ()):
+            logger.warning(
+                'Register %s can not move from %s to %s' % (
+                    register.id, current, status
+                )
+            )
+            return False
+
+        if not cls._lock_nowait(register.id):
+            # Locked by a concurrent transition
+            return False
+
+        where = (table.id == register.id) & (table.version == version)
+        if register.status:
+            where &= (table.status == register.status)
+        else:
+            where &= (table.status == Null)
+        cursor.execute(*table.update(
+            [table.version], [version + 1], where=where
+        ))
+        if cursor.rowcount != 1:
+            return False
+
+        values = dict(values or {}, status=status, version=version + 1)
+        cls.write([register], values)
+        RegisterLog.create([{
+            'register': register.id,
+            'message': message or 'Status changed from %s to %s' % (
+                current, status
+            ),
+        }])
+        return True
+
+    @classmethod
+    def _lock_nowait(cls, register_id):
+        """Lock the row of the register without waiting, and return False
+        if another transaction holds it. Only PostgreSQL has row locks, on
+        the other backends this always succeeds.
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        cursor = Transaction().cursor
+
+        if CONFIG['db_type'] != 'postgresql':
+            return True
+        cursor.execute('SAVEPOINT register_lock')
+        try:
+            cursor.execute(
+                'SELECT id FROM "%s" WHERE id = %%s FOR UPDATE NOWAIT'
+                % cls._table, (register_id, )
+            )
+        except DatabaseOperationalError:
+            cursor.execute('ROLLBACK TO SAVEPOINT register_lock')
+            return False
+        cursor.execute('RELEASE SAVEPOINT register_lock')
+        return True
+
+    @classmethod
+    def claim_job(cls, register):
+        """Claim the asynchronous payment job of the register, and return
+        False if the job is not pending or if another worker claimed it less
+        than `_job_timeout` ago. A job is claimed before its gateway is
+        called so that a queue and the `run_pending_jobs` cron never both
+        run it.
+
+        :param register: Active record of the payment register
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if not cls._lock_nowait(register.id):
+            return False
+
+        now = datetime.now()
+        where = (table.id == register.id) & (table.status == 'in-progress')
+        where &= (table.action != Null)
+        stale = table.job_claimed_at < now - cls._job_timeout
+        where &= (table.job_claimed_at == Null) | stale
+        cursor.execute(*table.update(
+            [table.job_claimed_at], [now], where=where
+        ))
+        return cursor.rowcount == 1
+
+    @classmethod
+    def run_pending_jobs(cls):
+        """Run the asynchronous payment jobs which no queue ran. This is
+        called by a cron and runs the jobs of the `DatabaseJobQueue`, the
+        jobs queued more than `_job_grace` ago which no worker claimed, and
+        the jobs claimed by a worker which did not finish them within
+        `_job_timeout`. Each job is committed on its own.
+        """
+        PaymentGateway = Pool().get('nereid.payment.gateway')
+        cursor = Transaction().cursor
+
+        now = datetime.now()
+        registers = cls.search([
+            ('status', '=', 'in-progress'),
+            ('action', '!=', None),
+            ['OR', [
+                ('job_claimed_at', '=', None),
+                ('create_date', '<', now - cls._job_grace),
+            ], [
+                ('job_claimed_at', '<', now - cls._job_timeout),
+            ]],
+        ])
+        for register in registers:
+            PaymentGateway.run_payment_job(register, commit_claim=True)
+            cursor.commit()
+
+    @classmethod
+    def ingest(cls, payloads):
+        """Create registers and their logs in bulk, for example from a burst
+        of provider notifications.
+
+        Each payload is a dictionary of the values of a register with an
+        optional `logs` key holding a list of log messages. A payload whose
+        (`method`, `transaction_id`) matches an existing register, or an
+        earlier payload of the batch, does not create a register; its logs
+        are appended to the matching register instead.
+
+        :param payloads: list of dictionaries
+        :return: list of (outcome, register) tuples in the order of the
+                 payloads, where outcome is either `created` or `duplicate`
+        """
+        RegisterLog = Pool().get('nereid.payment.register.log')
+
+        transaction_ids = set(
+            p['transaction_id'] for p in payloads if p.get('transaction_id')
+        )
+        existing = {}
+        if transaction_ids:
+            registers = cls.search([
+                ('transaction_id', 'in', list(transaction_ids)),
+            ])
+            for register in registers:
+                existing[(register.method, register.transaction_id)] = \
+                    register
+
+        to_create, items, batch_keys = [], [], {}
+        for payload in payloads:
+            values = payload.copy()
+            messages = values.pop('logs', None) or []
+            key = (values.get('method'), values.get('transaction_id'))
+            if key[1] and key in existing:
+                items.append(('duplicate', existing[key], messages))
+            elif key[1] and key in batch_keys:
+                items.append(('duplicate', batch_keys[key], messages))
+            else:
+                if key[1]:
+                    batch_keys[key] = len(to_create)
+                items.append(('created', len(to_create), messages))
+                to_create.append(values)
+
+        registers = cls.create(to_create) if to_create else []
+
+        rv, log_vlist = [], []
+        for outcome, register, messages in items:
+            if not isinstance(register, cls):
+                # Index of a register created from this batch
+                register = registers[register]
+            rv.append((outcome, register))
+            log_vlist.extend([{
+                'register': register.id,
+                'message': message,
+            } for message in messages])
+        if log_vlist:
+            RegisterLog.create(log_vlist)
+        return rv
+
+    @classmethod
+    def validate_batch(cls, items):
+        """Check a batch of payments, for example the lines of a provider
+        settlement, against their sales and the registers.
+
+        The totals and currencies of all the sales are loaded at once, and
+        the payments are compared in a single pass. Each item is a
+        dictionary with the `sale` ID, the `amount` and the `currency` ID of
+        the payment, and optionally its `method` and `transaction_id`.
+
+        :return: A list with the set of problems of each item, in order.
+                 The problems are `unknown_sale`, `amount_mismatch`,
+                 `currency_mismatch` and `duplicate` (the transaction is
+                 already registered or appears earlier in the batch).
+        """
+        Sale = Pool().get('sale.sale')
+
+        sale_ids = list(set(item['sale'] for item in items))
+        sales = dict(
+            (values['id'], values) for values in Sale.search_read([
+                ('id', 'in', sale_ids),
+            ], fields_names=['total_amount', 'currency'])
+        ) if sale_ids else {}
+
+        transaction_ids = list(set(
+            item['transaction_id'] for item in items
+            if item.get('transaction_id')
+        ))
+        seen = set()
+        if transaction_ids:
+            seen.update(
+                (values['method'], values['transaction_id'])
+                for values in cls.search_read([
+                    ('transaction_id', 'in', transaction_ids),
+                ], fields_names=['method', 'transaction_id'])
+            )
+
+        rv = []
+        for item in items:
+            problems = set()
+            sale = sales.get(item['sale'])
+            if sale is None:
+                problems.add('unknown_sale')
+            else:
+                if Decimal(str(item['amount'])) != sale['total_amount']:
+                    problems.add('amount_mismatch')
+                if item['currency'] != sale['currency']:
+                    problems.add('currency_mismatch')
+            if item.get('transaction_id'):
+                key = (item.get('method'), item['transaction_id'])
+                if key in seen:
+                    problems.add('duplicate')
+                seen.add(key)
+            rv.append(problems)
+        return rv
 
 
 class RegisterLog(ModelSQL, ModelView):
@@ -68,6 +518,261 @@ class RegisterLog(ModelSQL, ModelView):
     )
     message = fields.Text('Message')
 
+    @classmethod
+    def archive_logs(cls, days=90, batch_size=1000):
+        """Move the logs older than the given number of days into the
+        compressed log archive of their register. This is called by a cron.
+
+        :param days: The retention period of the logs, in days
+        :param batch_size: Number of logs archived at a time
+        """
+        Register = Pool().get('nereid.payment.register')
+        Archive = Pool().get('nereid.payment.register.log.archive')
+
+        cutoff = datetime.now() - timedelta(days=days)
+        while True:
+            logs = cls.search([
+                ('create_date', '<', cutoff),
+            ], order=[('register', 'ASC'), ('id', 'ASC')], limit=batch_size)
+            if not logs:
+                break
+            for register, register_logs in groupby(
+                    logs, key=lambda log: log.register):
+                entries = [{
+                    'create_date': log.create_date.isoformat(),
+                    'message': log.message,
+                } for log in register_logs]
+                if register.log_archive:
+                    register.log_archive.add_logs(entries)
+                else:
+                    archive, = Archive.create([{'register': register.id}])
+                    archive.add_logs(entries)
+                    Register.write([register], {'log_archive': archive.id})
+            cls.delete(logs)
+
+
+class RegisterLogArchive(ModelSQL):
+    """Archive of the logs of a payment register
+
+    The logs are stored as zlib compressed JSON so that old logs take little
+    space and keep the table of the logs small.
+    """
+    __name__ = "nereid.payment.register.log.archive"
+
+    register = fields.Many2One(
+        'nereid.payment.register', 'Register', required=True,
+        ondelete='CASCADE', select=True
+    )
+    data = fields.Binary('Data')
+    count = fields.Integer('Count')
+
+    @staticmethod
+    def default_count():
+        return 0
+
+    def get_logs(self):
+        "Return the archived logs as a list of dictionaries, oldest first"
+        if not self.data:
+            return []
+        return json.loads(zlib.decompress(str(self.data)))
+
+    def add_logs(self, entries):
+        """Append the given logs to the archive
+
+        :param entries: List of dictionaries with a `create_date` in ISO
+                        format and a `message`
+        """
+        logs = self.get_logs() + entries
+        self.write([self], {
+            'data': buffer(zlib.compress(json.dumps(logs), 9)),
+            'count': len(logs),
+        })
+
+
+class RegisterAggregate(ModelSQL):
+    """Payment Register Aggregate
+
+    The number and total amount of the registers per day of creation,
+    website, payment model, currency and status. It is updated when
+    registers are created, written or deleted so that dashboards do not
+    scan the registers.
+
+    The updates only insert rows of signed deltas, so that concurrent
+    payments never wait on a shared row. The totals must always be summed,
+    as `get_totals` does, and the deltas are summed into one row per key by
+    `compact`, which a cron runs daily.
+    """
+    __name__ = "nereid.payment.register.aggregate"
+
+    #: The fields of the register whose change updates the aggregates
+    AGGREGATED_FIELDS = ('website', 'method', 'currency', 'status', 'amount')
+
+    date = fields.Date('Date', required=True, select=True)
+    website = fields.Many2One(
+        'nereid.website', 'Website', required=True, ondelete='CASCADE'
+    )
+    method = fields.Char('Payment Model', required=True)
+    currency = fields.Many2One(
+        'currency.currency', 'Currency', required=True, ondelete='CASCADE'
+    )
+    status = fields.Char('Status')
+    count = fields.Integer('Count', required=True)
+    amount = fields.Numeric('Amount', required=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(RegisterAggregate, cls).__register__(module_name)
+
+        table = TableHandler(Transaction().cursor, cls, module_name)
+        table.index_action(
+            ['date', 'website', 'method', 'currency', 'status'], 'add'
+        )
+
+    @classmethod
+    def _get_key(cls, date, website, method, currency, status):
+        return (date, website, method, currency, status or '')
+
+    @classmethod
+    def add(cls, registers, sign=1):
+        """Add the given registers to the aggregates, or subtract them if
+        sign is -1, with a row of deltas per key
+        """
+        totals = {}
+        for register in registers:
+            key = cls._get_key(
+                register.create_date.date(), register.website.id,
+                register.method, register.currency.id, register.status
+            )
+            count, amount = totals.get(key, (0, Decimal('0')))
+            totals[key] = (count + sign, amount + sign * register.amount)
+
+        if totals:
+            cls.create([dict(zip(
+                ['date', 'website', 'method', 'currency', 'status'], total_key
+            ), count=total_count, amount=total_amount)
+                for total_key, (total_count, total_amount)
+                in totals.iteritems()])
+
+    @classmethod
+    def compact(cls):
+        """Sum the rows of deltas into a row per key. The rows inserted by
+        the transactions which commit in the meantime are left as they are.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        cursor.execute(*table.select(Max(table.id)))
+        max_id, = cursor.fetchone()
+        if max_id is None:
+            return
+
+        columns = [
+            table.date, table.website, table.method, table.currency,
+            table.status,
+        ]
+        cursor.execute(*table.select(*(columns + [
+            Sum(table.count), Sum(table.amount),
+        ]), where=table.id <= max_id, group_by=columns))
+        totals = [
+            (row[:5], int(row[5] or 0), Decimal(str(row[6] or 0)))
+            for row in cursor.fetchall()
+        ]
+
+        cursor.execute(*table.delete(where=table.id <= max_id))
+        cls.create([dict(zip(
+            ['date', 'website', 'method', 'currency', 'status'], key
+        ), count=count, amount=amount)
+            for key, count, amount in totals if count or amount])
+
+    @classmethod
+    def get_totals(cls, date_from=None, date_to=None, websites=None,
+            methods=None, currencies=None, statuses=None,
+            group_by=('date', 'website', 'method', 'currency', 'status')):
+        """Return the number and total amount of the registers, grouped by
+        the given fields, as a list of dictionaries with the keys of
+        `group_by`, `count` and `amount`.
+
+        :param date_from: First date included
+        :param date_to: Last date included
+        :param websites: List of website IDs
+        :param methods: List of payment models
+        :param currencies: List of currency IDs
+        :param statuses: List of statuses
+        :param group_by: The fields the totals are grouped by
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        where = Literal(True)
+        if date_from:
+            where &= (table.date >= date_from)
+        if date_to:
+            where &= (table.date <= date_to)
+        for name, values in (
+                ('website', websites), ('method', methods),
+                ('currency', currencies), ('status', statuses)):
+            if values:
+                where &= getattr(table, name).in_(values)
+
+        columns = [getattr(table, name) for name in group_by]
+        cursor.execute(*table.select(*(columns + [
+            Sum(table.count), Sum(table.amount),
+        ]), where=where, group_by=columns or None, order_by=columns or None))
+
+        rv = []
+        for row in cursor.fetchall():
+            values = dict(zip(group_by, row))
+            values['count'] = int(row[-2] or 0)
+            values['amount'] = Decimal(str(row[-1] or 0))
+            if not values['count'] and not values['amount']:
+                # The deltas of the group cancel out
+                continue
+            rv.append(values)
+        return rv
+
+    @classmethod
+    def rebuild(cls, batch_size=1000):
+        """Recompute all the aggregates from the registers. This is used to
+        backfill the aggregates.
+        """
+        Register = Pool().get('nereid.payment.register')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        register = Register.__table__()
+
+        totals = {}
+        last_id = 0
+        while True:
+            cursor.execute(*register.select(
+                register.id, register.create_date, register.website,
+                register.method, register.currency, register.status,
+                register.amount,
+                where=register.id > last_id,
+                order_by=register.id.asc, limit=batch_size,
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            for row in rows:
+                create_date = row[1]
+                if isinstance(create_date, basestring):
+                    create_date = datetime.strptime(
+                        create_date[:19], '%Y-%m-%d %H:%M:%S'
+                    )
+                key = cls._get_key(create_date.date(), *row[2:6])
+                count, amount = totals.get(key, (0, Decimal('0')))
+                totals[key] = (count + 1, amount + Decimal(str(row[6])))
+            last_id = rows[-1][0]
+
+        cursor.execute(*table.delete())
+        cls.create([dict(zip(
+            ['date', 'website', 'method', 'currency', 'status'], total_key
+        ), count=total_count, amount=total_amount)
+            for total_key, (total_count, total_amount)
+            in totals.iteritems()])
+
 
 class Invoice:
     "Add payment register record to sale"
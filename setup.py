@@ -147,6 +147,11 @@ setup(
     entry_points="""
     [trytond.modules]
     nereid_payment = trytond.modules.nereid_payment
+
+    [console_scripts]
+    nereid_payment_export = trytond.modules.nereid_payment.commands:export
+    nereid_payment_rebuild = trytond.modules.nereid_payment.commands:rebuild
+    nereid_payment_drain = trytond.modules.nereid_payment.commands:drain
     """,
     test_suite='tests',
     test_loader='trytond.test_loader:Loader',
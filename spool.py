@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+    spool
+
+    An append-only spool of the notifications (webhooks) of the payment
+    providers.
+
+    The webhook route only appends the raw notification to the spool, which
+    is a file of JSON lines local to the node, and answers the provider
+    right away without touching the database. The notifications are applied
+    to the payment registers later, in batches, by
+    `nereid.payment.gateway.drain_webhooks`.
+
+    Writers and drainers coordinate with `flock`. A drainer renames the
+    spool to a segment while it holds the lock, so writers which opened the
+    spool before the rename notice it once they get the lock and append to
+    the new spool instead. A segment is removed once its notifications are
+    committed, and the segments left by an interrupted drain are drained
+    again.
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import os
+import glob
+import json
+import time
+import fcntl
+import logging
+
+__all__ = ['Spool']
+
+logger = logging.getLogger('nereid.payment.spool')
+
+
+class Spool(object):
+    """Spool of notifications at the given path
+
+    :param path: Path of the spool file, the segments being drained are
+                 next to it
+    :param fsync: Whether the appends are synced to the disk before they
+                  return
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+
+    def _open_locked(self):
+        "Open the current spool for appending and lock it"
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by a concurrent writer
+                pass
+        while True:
+            fileobj = open(self.path, 'ab')
+            fcntl.flock(fileobj, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fileobj.fileno()).st_ino == \
+                        os.stat(self.path).st_ino:
+                    return fileobj
+            except OSError:
+                # Renamed and not created again yet
+                pass
+            # Rotated while waiting for the lock
+            fileobj.close()
+
+    def append(self, event):
+        """Append the event to the spool
+
+        :param event: A dictionary which can be serialised to JSON
+        """
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        fileobj = self._open_locked()
+        try:
+            fileobj.write(line)
+            fileobj.flush()
+            if self.fsync:
+                os.fsync(fileobj.fileno())
+        finally:
+            fileobj.close()
+
+    def rotate(self):
+        """Move the events of the spool to a new segment and return the
+        paths of all the segments to drain, oldest first
+        """
+        if os.path.exists(self.path):
+            fileobj = self._open_locked()
+            try:
+                if os.fstat(fileobj.fileno()).st_size:
+                    os.rename(
+                        self.path, '%s.%017.6f' % (self.path, time.time())
+                    )
+            finally:
+                fileobj.close()
+        return sorted(glob.glob(self.path + '.*'))
+
+    def read(self, segment):
+        """Yield the events of the segment, skipping the lines which can
+        not be decoded, such as a line cut by a crash
+        """
+        with open(segment, 'rb') as fileobj:
+            for number, line in enumerate(fileobj, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.error(
+                        'Skipping line %d of %s which can not be decoded' %
+                        (number, segment)
+                    )
+
+    def lock(self, segment):
+        """Lock the segment for draining and return its locked file, or None
+        if another drainer has it
+        """
+        try:
+            fileobj = open(segment, 'rb')
+        except IOError:
+            # Drained and removed by another drainer
+            return None
+        try:
+            fcntl.flock(fileobj, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fileobj.close()
+            return None
+        if not os.path.exists(segment):
+            fileobj.close()
+            return None
+        return fileobj
+
+    def remove(self, segment):
+        "Remove a drained segment"
+        os.remove(segment)
@@ -7,4 +7,15 @@
     :license: GPLv3, see LICENSE for more details.
 """
 #Flake8: noqa
-from test_payment import suite
+import unittest
+
+import test_payment
+import test_transport
+
+
+def suite():
+    "Nereid payment test suite"
+    suite = unittest.TestSuite()
+    suite.addTests(test_payment.suite())
+    suite.addTests(test_transport.suite())
+    return suite
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Nereid Payment Benchmarks
+
+    Measures the latency and the number of queries of the checkout payment
+    path against a synthetic dataset. This is not part of the test suite;
+    run it with::
+
+        python -m trytond.modules.nereid_payment.tests.benchmark
+
+    The database is the one of the Tryton test suite (SQLite in memory
+    unless DB_NAME and the trytond config point to PostgreSQL). The size of
+    the dataset and the number of iterations are read from the environment:
+
+        * BENCH_GATEWAYS (default: 200)
+        * BENCH_COUNTRIES (default: 50)
+        * BENCH_WEBSITES (default: 5)
+        * BENCH_ADDRESSES (default: 1000)
+        * BENCH_ITERATIONS (default: 100)
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+'''
+import os
+import sys
+import time
+import unittest
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+
+from trytond.modules.nereid_cart_b2c.tests.test_product import BaseTestCase
+from trytond.modules.nereid_payment.instrumentation import QueryCounter
+
+GATEWAYS = int(os.environ.get('BENCH_GATEWAYS', 200))
+COUNTRIES = int(os.environ.get('BENCH_COUNTRIES', 50))
+WEBSITES = int(os.environ.get('BENCH_WEBSITES', 5))
+ADDRESSES = int(os.environ.get('BENCH_ADDRESSES', 1000))
+ITERATIONS = int(os.environ.get('BENCH_ITERATIONS', 100))
+
+
+def percentile(values, percent):
+    "Return the percentile of the sorted values by the nearest rank"
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[index]
+
+
+class Benchmark(BaseTestCase):
+    "Benchmark of the checkout payment path"
+
+    results = []
+
+    def setUp(self):
+        super(Benchmark, self).setUp()
+        trytond.tests.test_tryton.install_module('nereid_payment')
+
+        self.Address = POOL.get('party.address')
+        self.Country = POOL.get('country.country')
+        self.Payment = POOL.get('nereid.payment.gateway')
+        self.Register = POOL.get('nereid.payment.register')
+
+    def measure(self, name, function, iterations=ITERATIONS):
+        """Call the function the given number of times and record the
+        latencies and the number of queries of the calls
+        """
+        latencies, queries = [], []
+        for iteration in xrange(iterations):
+            with QueryCounter() as counter:
+                start = time.time()
+                function(iteration)
+                latencies.append((time.time() - start) * 1000)
+            queries.append(counter.count)
+        latencies.sort()
+        self.results.append((
+            name,
+            percentile(latencies, 50),
+            percentile(latencies, 95),
+            percentile(latencies, 99),
+            sum(queries) / float(len(queries)),
+        ))
+
+    def setup_dataset(self):
+        """Create the synthetic dataset of gateways, countries, websites and
+        addresses
+        """
+        self.setup_defaults()
+
+        website, = self.NereidWebsite.search([])
+        websites = [website]
+        for index in xrange(1, WEBSITES):
+            websites.extend(self.NereidWebsite.copy([website], {
+                'name': 'bench-%d' % index,
+            }))
+        countries = self.Country.create([{
+            'name': 'Bench Country %d' % index,
+        } for index in xrange(COUNTRIES)])
+
+        cod, = self.Payment.search([
+            ('model.model', '=', 'nereid.payment.cod'),
+        ])
+        self.Payment.create([{
+            'name': 'Bench Gateway %d' % index,
+            'model': cod.model.id,
+            'sequence': index,
+            'is_allowed_for_guest': bool(index % 2),
+            'available_countries': [('add', map(int, countries))],
+            'websites': [('add', map(int, websites))],
+        } for index in xrange(GATEWAYS)])
+
+        party = self.registered_user.party
+        self.Address.create([{
+            'party': party.id,
+            'country': countries[index % COUNTRIES].id,
+        } for index in xrange(ADDRESSES)])
+
+        return website, websites, countries, cod
+
+    def test_benchmark(self):
+        "Benchmark the payment path"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            website, websites, countries, cod = self.setup_dataset()
+            app = self.get_app()
+            address = self.registered_user.party.addresses[-1]
+
+            def cold_lookup(i):
+                self.Payment._clear_caches()
+                self.Payment._get_available_gateways(countries[i % COUNTRIES])
+
+            with app.test_request_context('/'):
+                self.measure('_get_available_gateways (cold)', cold_lookup)
+                self.measure(
+                    '_get_available_gateways (warm)',
+                    lambda i: self.Payment._get_available_gateways(
+                        countries[i % COUNTRIES]
+                    )
+                )
+                self.measure(
+                    'get_availability_map (all countries and websites)',
+                    lambda i: self.Payment.get_availability_map(
+                        countries, websites, guest=False
+                    ), iterations=max(ITERATIONS / 10, 1)
+                )
+
+            with app.test_client() as c:
+                self.measure(
+                    'GET /_available_gateways (country)',
+                    lambda i: c.get(
+                        '/_available_gateways?value=%d' %
+                        countries[i % COUNTRIES].id
+                    )
+                )
+                self.login(c, 'email@example.com', 'password')
+                self.measure(
+                    'GET /_available_gateways (address)',
+                    lambda i: c.get(
+                        '/_available_gateways?value=%d&type=address' %
+                        address.id
+                    )
+                )
+
+            self.NereidWebsite.write([website], {
+                'allowed_gateways': [('add', [cod.id])],
+            })
+            self.Payment.write([cod], {
+                'available_countries': [('add', [address.country.id])],
+            })
+            sale, = self.Sale.create([{
+                'party': self.registered_user.party.id,
+                'company': website.company.id,
+                'currency': website.company.currency.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+            }])
+            with app.test_request_context('/'):
+                self.measure(
+                    'PaymentGateway.process (COD)',
+                    lambda i: self.Payment.process(sale, cod.id)
+                )
+
+            values = {
+                'reference': 'BENCH',
+                'company': website.company.id,
+                'website': website.id,
+                'method': 'nereid.payment.cod',
+                'amount': 10,
+                'currency': website.company.currency.id,
+            }
+            self.measure(
+                'Register.create with a log',
+                lambda i: self.Register.create([dict(
+                    values, transaction_id='single-%d' % i,
+                    logs=[('create', [{'message': 'Benchmark'}])],
+                )])
+            )
+            self.measure(
+                'Register.ingest (100 payloads)',
+                lambda i: self.Register.ingest([dict(
+                    values, transaction_id='batch-%d-%d' % (i, index),
+                    logs=['Benchmark'],
+                ) for index in xrange(100)]),
+                iterations=max(ITERATIONS / 10, 1)
+            )
+
+        self.report()
+
+    def report(self, stream=sys.stdout):
+        stream.write('\n%-52s %9s %9s %9s %8s\n' % (
+            'Benchmark', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'
+        ))
+        for name, p50, p95, p99, queries in self.results:
+            stream.write('%-52s %9.2f %9.2f %9.2f %8.1f\n' % (
+                name, p50, p95, p99, queries
+            ))
+
+
+def suite():
+    "Payment benchmark suite"
+    suite = unittest.TestSuite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(Benchmark))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
@@ -6,14 +6,29 @@
     :copyright: (c) 2010-2013 by Openlabs Technologies & Consulting (P) Ltd.
     :license: GPLv3, see LICENSE for more details
 '''
+import os
+import csv
 import json
+import shutil
+import tempfile
 import unittest
+from StringIO import StringIO
+
+from babel.messages.catalog import Catalog
+from babel.messages.mofile import write_mo
+from werkzeug.exceptions import Conflict, Forbidden
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from nereid import redirect
 
 from trytond.modules.nereid_cart_b2c.tests.test_product import BaseTestCase
+from trytond.modules.nereid_payment import (
+    breaker, gateway, i18n, instrumentation,
+)
+from trytond.modules.nereid_payment.jobs import ImmediateJobQueue
 
 
 class TestPayment(BaseTestCase):
@@ -30,6 +45,36 @@ class TestPayment(BaseTestCase):
             'localhost/checkout.jinja': '{{form.errors|safe}}',
         })
 
+    def _setup_cod_sales(self, count, asynchronous=False):
+        """Make COD available on the website for the country of the address
+        of the registered user, and create sales of that user.
+
+        :return: The website, the COD gateway and the list of sales
+        """
+        website, = self.NereidWebsite.search([])
+        country = website.countries[0]
+        cod, = self.Payment.search([
+            ('model.model', '=', 'nereid.payment.cod'),
+        ])
+        self.Payment.write([cod], {
+            'asynchronous': asynchronous,
+            'available_countries': [('add', [country.id])],
+        })
+        self.NereidWebsite.write([website], {
+            'allowed_gateways': [('add', [cod.id])],
+        })
+
+        address = self.registered_user.party.addresses[0]
+        self.Address.write([address], {'country': country.id})
+        sales = self.Sale.create([{
+            'party': self.registered_user.party.id,
+            'company': website.company.id,
+            'currency': website.company.currency.id,
+            'invoice_address': address.id,
+            'shipment_address': address.id,
+        } for index in xrange(count)])
+        return website, cod, sales
+
     def test_0010_check_cart(self):
         """Assert nothing broke the cart."""
         with Transaction().start(DB_NAME, USER, CONTEXT):
@@ -148,6 +193,795 @@ class TestPayment(BaseTestCase):
                 json_result = json.loads(result.data)['result']
                 self.assertEqual(len(json_result), 1)
 
+    def test_0060_config_generation(self):
+        "Changing the gateway configuration must bump the generation"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            Generation = POOL.get('nereid.payment.gateway.generation')
+
+            generation = Generation.get_generation()
+            website, = self.NereidWebsite.search([])
+            payment_method = self.Payment.search([])[0]
+
+            self.NereidWebsite.write([website], {
+                'allowed_gateways': [('add', [payment_method])]
+            })
+            self.assertTrue(Generation.get_generation() > generation)
+
+            generation = Generation.get_generation()
+            self.Payment.write([payment_method], {'active': False})
+            self.assertEqual(Generation.get_generation(), generation + 1)
+
+    def test_0070_available_gateways_etag(self):
+        "A conditional request with a matching ETag must get a 304"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            website, = self.NereidWebsite.search([])
+            country_id = website.countries[0].id
+            payment_method = self.Payment.search([])[0]
+            self.Payment.write([payment_method], {
+                'available_countries': [('add', [country_id])]
+            })
+            self.NereidWebsite.write([website], {
+                'allowed_gateways': [('add', [payment_method])]
+            })
+
+            with app.test_client() as c:
+                url = '/_available_gateways?value=%s' % country_id
+                rv = c.get(url)
+                self.assertTrue(
+                    'private' in rv.headers.get('Cache-Control')
+                )
+                rv = c.get(url + '&guest=0')
+                self.assertEqual(rv.status_code, 400)
+
+                # Responses to guests are shared on the URL which says so
+                url += '&guest=1'
+                rv = c.get(url)
+                self.assertEqual(rv.status_code, 200)
+                self.assertTrue(rv.headers.get('ETag'))
+                self.assertTrue(
+                    'public' in rv.headers.get('Cache-Control')
+                )
+
+                rv2 = c.get(url, headers={
+                    'If-None-Match': rv.headers['ETag']
+                })
+                self.assertEqual(rv2.status_code, 304)
+
+            # Once the configuration changes the ETag changes too
+            self.Payment.write([payment_method], {'sequence': 5})
+
+            with app.test_client() as c:
+                rv3 = c.get(url, headers={
+                    'If-None-Match': rv.headers['ETag']
+                })
+                self.assertEqual(rv3.status_code, 200)
+
+    def test_0080_availability_map(self):
+        "Availability of many countries must be returned in one call"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            website, = self.NereidWebsite.search([])
+            country1, country2 = POOL.get('country.country').create([{
+                'name': 'Country 1', 'code': 'C1',
+            }, {
+                'name': 'Country 2', 'code': 'C2',
+            }])
+            gateway1, gateway2 = self.Payment.search([])[:2]
+            self.Payment.write([gateway1], {
+                'available_countries': [('add', [country1.id])],
+                'sequence': 20,
+            })
+            self.Payment.write([gateway2], {
+                'available_countries': [
+                    ('add', [country1.id, country2.id])
+                ],
+                'sequence': 10,
+                'is_allowed_for_guest': False,
+            })
+            self.NereidWebsite.write([website], {
+                'allowed_gateways': [('add', [gateway1.id, gateway2.id])]
+            })
+
+            availability = self.Payment.get_availability_map(
+                [country1, country2], [website], guest=False
+            )
+            self.assertEqual(availability, {
+                website.id: {
+                    country1.id: [gateway2.id, gateway1.id],
+                    country2.id: [gateway2.id],
+                }
+            })
+            availability = self.Payment.get_availability_map(
+                [country1, country2], [website], guest=True
+            )
+            self.assertEqual(availability[website.id][country2.id], [])
+
+            with app.test_client() as c:
+                rv = c.get(
+                    '/_available_gateways/map?countries=%d&countries=%d' % (
+                        country1.id, country2.id
+                    )
+                )
+                result = json.loads(rv.data)['result']
+                self.assertEqual(
+                    [g['id'] for g in result[str(country1.id)]],
+                    [gateway1.id]
+                )
+                self.assertEqual(result[str(country2.id)], [])
+
+            # Deactivated gateways are removed from the availability
+            self.Payment.write([gateway2], {'active': False})
+            availability = self.Payment.get_availability_map(
+                [country1, country2], [website], guest=False
+            )
+            self.assertEqual(
+                availability[website.id][country1.id], [gateway1.id]
+            )
+            self.assertEqual(availability[website.id][country2.id], [])
+
+    def test_0090_register_ingest(self):
+        "Registers must be created in bulk and deduplicated"
+        Register = POOL.get('nereid.payment.register')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            website, = self.NereidWebsite.search([])
+            values = {
+                'reference': 'SO-1',
+                'company': website.company.id,
+                'website': website.id,
+                'method': 'nereid.payment.cod',
+                'amount': 10,
+                'currency': website.company.currency.id,
+            }
+            payloads = [
+                dict(values, transaction_id='T1', logs=['created']),
+                dict(values, transaction_id='T2'),
+                dict(values, transaction_id='T1', logs=['retried']),
+            ]
+            rv = Register.ingest(payloads)
+            self.assertEqual(
+                [outcome for outcome, _ in rv],
+                ['created', 'created', 'duplicate']
+            )
+            self.assertEqual(rv[0][1], rv[2][1])
+            self.assertEqual(len(rv[0][1].logs), 2)
+
+            # A later batch is deduplicated against the database
+            rv = Register.ingest([dict(values, transaction_id='T2')])
+            self.assertEqual(rv[0][0], 'duplicate')
+            self.assertEqual(Register.search([], count=True), 2)
+
+            register = Register.find_by_transaction('nereid.payment.cod', 'T1')
+            self.assertEqual(register.transaction_id, 'T1')
+            self.assertEqual(
+                Register.find_by_transaction('nereid.payment.cod', 'T1'),
+                register
+            )
+            self.assertEqual(
+                Register.find_by_transaction('nereid.payment.cod', 'T3'),
+                None
+            )
+            self.assertEqual(
+                Register.find_by_reference(website, 'SO-1').reference,
+                'SO-1'
+            )
+
+    def test_0100_instrumentation_headers(self):
+        "Instrumented routes must send their metrics in debug mode"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            metrics = []
+            app.debug = True
+            app.config['PAYMENT_INSTRUMENTATION'] = True
+            app.config['PAYMENT_METRICS_CALLBACK'] = \
+                lambda name, values: metrics.append((name, values))
+
+            with app.test_client() as c:
+                rv = c.get('/_available_gateways?value=1')
+                self.assertTrue(
+                    int(rv.headers['X-Payment-Queries']) > 0
+                )
+                self.assertTrue('X-Payment-Total-Time' in rv.headers)
+
+            self.assertEqual(len(metrics), 1)
+            self.assertEqual(metrics[0][0], 'get_available_gateways')
+
+            # Nested counters both count and restore the execute of the
+            # cursor they found
+            cursor = Transaction().cursor
+            with instrumentation.QueryCounter() as outer:
+                with instrumentation.QueryCounter() as inner:
+                    cursor.execute('SELECT 1')
+                cursor.execute('SELECT 1')
+            self.assertEqual((outer.count, inner.count), (2, 1))
+            self.assertFalse('execute' in cursor.__dict__)
+
+    def test_0110_archive_register_logs(self):
+        "Old logs must be moved to the compressed archive of the register"
+        Register = POOL.get('nereid.payment.register')
+        RegisterLog = POOL.get('nereid.payment.register.log')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            website, = self.NereidWebsite.search([])
+            (_, register), = Register.ingest([{
+                'reference': 'SO-1',
+                'company': website.company.id,
+                'website': website.id,
+                'method': 'nereid.payment.cod',
+                'amount': 10,
+                'currency': website.company.currency.id,
+                'logs': ['first', 'second'],
+            }])
+
+            # A negative retention archives everything
+            RegisterLog.archive_logs(days=-1)
+            register = Register(register.id)
+            self.assertEqual(len(register.logs), 0)
+            self.assertEqual(
+                [log['message'] for log in register.log_archive.get_logs()],
+                ['first', 'second']
+            )
+            self.assertTrue('second' in register.archived_logs)
+
+    def test_0120_export_registers(self):
+        "Registers must be exported in batches and resumable"
+        from trytond.modules.nereid_payment.export import export_registers
+        Register = POOL.get('nereid.payment.register')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            website, = self.NereidWebsite.search([])
+            Register.ingest([{
+                'reference': 'SO-%d' % index,
+                'company': website.company.id,
+                'website': website.id,
+                'method': 'nereid.payment.cod',
+                'amount': index,
+                'currency': website.company.currency.id,
+                'status': 'complete' if index % 2 else 'failed',
+            } for index in range(5)])
+
+            output = StringIO()
+            self.assertEqual(
+                export_registers(output, 'csv', batch_size=2), 5
+            )
+            rows = list(csv.reader(StringIO(output.getvalue())))
+            self.assertEqual(len(rows), 6)
+            self.assertEqual(rows[1][2], 'SO-0')
+
+            output = StringIO()
+            self.assertEqual(export_registers(
+                output, 'jsonl', statuses=['complete'], batch_size=1
+            ), 2)
+            references = [
+                json.loads(line)['reference']
+                for line in output.getvalue().splitlines()
+            ]
+            self.assertEqual(references, ['SO-1', 'SO-3'])
+
+    def test_0130_register_aggregates(self):
+        "Aggregates must follow the creation and status of registers"
+        Register = POOL.get('nereid.payment.register')
+        Aggregate = POOL.get('nereid.payment.register.aggregate')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            website, = self.NereidWebsite.search([])
+            rv = Register.ingest([{
+                'reference': 'SO-%d' % index,
+                'company': website.company.id,
+                'website': website.id,
+                'method': 'nereid.payment.cod',
+                'amount': 10 * (index + 1),
+                'currency': website.company.currency.id,
+                'status': 'complete',
+            } for index in range(3)])
+            Register.write([rv[0][1]], {'status': 'failed'})
+
+            totals = Aggregate.get_totals(group_by=('status', ))
+            self.assertEqual(
+                [(t['status'], t['count'], t['amount']) for t in totals],
+                [('complete', 2, 50), ('failed', 1, 10)]
+            )
+
+            # The deltas are summed into a row per key
+            self.assertEqual(len(Aggregate.search([])), 3)
+            Aggregate.compact()
+            self.assertEqual(len(Aggregate.search([])), 2)
+            self.assertEqual(
+                Aggregate.get_totals(group_by=('status', )), totals
+            )
+
+            Aggregate.rebuild()
+            self.assertEqual(
+                Aggregate.get_totals(group_by=('status', )), totals
+            )
+
+    def test_0140_validate_batch(self):
+        "Batches of payments must be checked against their sales"
+        Register = POOL.get('nereid.payment.register')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            website, = self.NereidWebsite.search([])
+            currency = website.company.currency
+            address = self.registered_user.party.addresses[0]
+            sale, = self.Sale.create([{
+                'party': self.registered_user.party.id,
+                'company': website.company.id,
+                'currency': currency.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+            }])
+            item = {
+                'sale': sale.id,
+                'amount': sale.total_amount,
+                'currency': currency.id,
+                'method': 'nereid.payment.cod',
+            }
+
+            self.assertEqual(Register.validate_batch([
+                dict(item, transaction_id='T1'),
+                dict(item, amount=sale.total_amount + 1),
+                dict(item, sale=sale.id + 1000),
+                dict(item, transaction_id='T1'),
+            ]), [
+                set(),
+                set(['amount_mismatch']),
+                set(['unknown_sale']),
+                set(['duplicate']),
+            ])
+
+    def test_0150_website_config(self):
+        "The payment config snapshot must follow changes of the website"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+
+            website, = self.NereidWebsite.search([])
+            payment_method = self.Payment.search([])[0]
+
+            with app.test_request_context('/'):
+                config = self.Payment.get_website_config()
+                self.assertEqual(config.payment_mode, 'capture')
+                self.assertEqual(config.allowed_gateways, ())
+
+            self.NereidWebsite.write([website], {
+                'payment_mode': 'auth_if_available',
+                'allowed_gateways': [('add', [payment_method.id])],
+            })
+
+            with app.test_request_context('/'):
+                config = self.Payment.get_website_config()
+                self.assertEqual(config.payment_mode, 'auth_if_available')
+                self.assertEqual(
+                    config.allowed_gateways, (payment_method.id, )
+                )
+
+    def test_0160_process_many(self):
+        "Payments of many sales must be captured in one batch per gateway"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            website, cod, sales = self._setup_cod_sales(3)
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    self.Payment.process_many(
+                        [(sale, cod.id) for sale in sales[:2]]
+                    ), [True, True]
+                )
+
+            # Without a request, for example from a cron
+            self.assertEqual(
+                self.Payment.process_many(
+                    [(sales[2], cod.id)], website=website, guest=False
+                ), [True]
+            )
+            for sale in self.Sale.browse(map(int, sales)):
+                self.assertEqual(sale.payment_method, cod)
+                self.assertEqual(sale.invoice_method, 'shipment')
+                self.assertEqual(sale.shipment_method, 'order')
+
+            # A sale whose invoice address has no country has no gateway
+            address, = self.Address.create([{
+                'party': self.registered_user.party.id,
+            }])
+            sale, = self.Sale.create([{
+                'party': self.registered_user.party.id,
+                'company': website.company.id,
+                'currency': website.company.currency.id,
+                'invoice_address': address.id,
+                'shipment_address': address.id,
+            }])
+            self.assertRaises(
+                Forbidden, self.Payment.process_many, [(sale, cod.id)],
+                website=website, guest=False
+            )
+
+    def test_0170_circuit_breaker(self):
+        "Gateways must be hidden or demoted when their breaker trips"
+        Health = POOL.get('nereid.payment.gateway.health')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            app.config['PAYMENT_CIRCUIT_BREAKER'] = {'min_calls': 2}
+            app.config['PAYMENT_HEALTH_SYNC_INTERVAL'] = 3600
+            breaker._breakers.clear()
+
+            website, = self.NereidWebsite.search([])
+            country = website.countries[0]
+            gateway1, gateway2 = self.Payment.search([], limit=2)
+            self.Payment.write([gateway1], {'sequence': 1})
+            self.Payment.write([gateway2], {'sequence': 2})
+            self.Payment.write([gateway1, gateway2], {
+                'available_countries': [('add', [country.id])],
+            })
+            self.NereidWebsite.write([website], {
+                'allowed_gateways': [('add', [gateway1.id, gateway2.id])],
+            })
+
+            with app.test_request_context('/'):
+                self.assertEqual(
+                    self.Payment._get_available_gateways(country),
+                    [gateway1, gateway2]
+                )
+
+                # Two failures out of two payments open the breaker
+                self.Payment.record_outcome(gateway1.id, False, 0.1)
+                self.Payment.record_outcome(gateway1.id, False, 0.1)
+                self.assertEqual(
+                    self.Payment._get_available_gateways(country),
+                    [gateway2]
+                )
+                health, = Health.search([('gateway', '=', gateway1.id)])
+                self.assertEqual(health.state, 'open')
+                self.assertEqual(health.failures, 2)
+
+                # Shared by the current transaction, which may roll back
+                gateway_breaker = self.Payment._get_breaker(gateway1.id)
+                self.assertTrue(gateway_breaker.pending)
+
+                # Once the cooldown is over the gateway is offered last
+                gateway_breaker.opened_at -= gateway_breaker.cooldown
+                self.assertEqual(
+                    self.Payment.get_health(), {gateway1.id: 'half-open'}
+                )
+                self.assertEqual(
+                    self.Payment._get_available_gateways(country),
+                    [gateway2, gateway1]
+                )
+
+                # A successful probe closes the breaker
+                self.Payment.record_outcome(gateway1.id, True, 0.1)
+                self.assertEqual(
+                    self.Payment._get_available_gateways(country),
+                    [gateway1, gateway2]
+                )
+                health, = Health.search([('gateway', '=', gateway1.id)])
+                self.assertEqual(health.state, 'closed')
+            breaker._breakers.clear()
+
+    def test_0180_register_transition(self):
+        "Status transitions of registers must be compare and set"
+        Register = POOL.get('nereid.payment.register')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            website, = self.NereidWebsite.search([])
+            register, = Register.create([{
+                'reference': 'T1',
+                'company': website.company.id,
+                'website': website.id,
+                'method': 'nereid.payment.cod',
+                'amount': 10,
+                'currency': website.company.currency.id,
+            }])
+            self.assertEqual(register.status, 'draft')
+            self.assertEqual(register.version, 0)
+
+            # Not allowed by the state machine
+            self.assertFalse(Register.transition(register, 'complete'))
+
+            self.assertTrue(Register.transition(
+                register, 'in-progress', values={'process_status': 'sent'}
+            ))
+            register = Register(register.id)
+            self.assertEqual(register.status, 'in-progress')
+            self.assertEqual(register.process_status, 'sent')
+            self.assertEqual(register.version, 1)
+            self.assertEqual(
+                register.logs[-1].message,
+                'Status changed from draft to in-progress'
+            )
+
+            # A handler which read the register before the transition
+            # gets a conflict
+            self.assertFalse(Register.transition(
+                register, 'failed', version=0
+            ))
+            self.assertTrue(Register.transition(
+                register, 'complete', 'Payment notified'
+            ))
+            self.assertFalse(Register.transition(register, 'failed'))
+
+            register = Register(register.id)
+            self.assertEqual(register.status, 'complete')
+            self.assertEqual(register.version, 2)
+            self.assertEqual(len(register.logs), 2)
+
+            # Writes of the status outside of transitions bump the version
+            Register.write([register], {'process_status': 'settled'})
+            self.assertEqual(Register(register.id).version, 3)
+
+    def test_0190_webhook_spool(self):
+        "Notifications must be spooled and applied to the registers later"
+        Register = POOL.get('nereid.payment.register')
+        COD = POOL.get('nereid.payment.cod')
+
+        data_path = CONFIG['data_path']
+        CONFIG['data_path'] = tempfile.mkdtemp()
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            app.config['WTF_CSRF_ENABLED'] = True
+            website, = self.NereidWebsite.search([])
+
+            def parse_notification(event):
+                values = json.loads(event['body'])
+                return [{
+                    'reference': values['reference'],
+                    'transaction_id': values['id'],
+                    'company': website.company.id,
+                    'website': website.id,
+                    'method': 'nereid.payment.cod',
+                    'amount': values['amount'],
+                    'currency': website.company.currency.id,
+                    'status': values['status'],
+                    'logs': [event['body']],
+                }]
+
+            with app.test_client() as c:
+                # COD does not accept notifications
+                rv = c.post('/_payment_webhook/nereid.payment.cod', data='{}')
+                self.assertEqual(rv.status_code, 404)
+
+                # Only the webhook route is exempt from the CSRF protection
+                rv = c.post('/cart/add', data={
+                    'product': self.product1.id, 'quantity': 1
+                })
+                self.assertEqual(rv.status_code, 400)
+
+            # Introspected in addition to the declared capabilities
+            COD.parse_notification = staticmethod(parse_notification)
+            gateway._capabilities.clear()
+            try:
+                self.assertEqual(
+                    self.Payment.get_capabilities(COD), frozenset([
+                        'capture', 'capture_many', 'parse_notification',
+                    ])
+                )
+                with app.test_client() as c:
+                    for status in ('in-progress', 'in-progress', 'complete'):
+                        rv = c.post(
+                            '/_payment_webhook/nereid.payment.cod',
+                            data=json.dumps({
+                                'id': 'T1', 'reference': 'S1',
+                                'amount': 10, 'status': status,
+                            }), content_type='application/json'
+                        )
+                        self.assertEqual(rv.status_code, 200)
+                    self.assertEqual(Register.search([]), [])
+
+                spool = self.Payment._get_webhook_spool()
+                failed = self.Payment._get_webhook_spool(
+                    'payment_webhooks.failed.jsonl'
+                )
+                segment, = spool.rotate()
+                events = list(spool.read(segment))
+                self.assertEqual(len(events), 3)
+                self.assertEqual(events[0]['digest'], events[1]['digest'])
+
+                # The redelivered notification is applied once
+                self.assertEqual(
+                    self.Payment._apply_webhooks(
+                        [events[0], events[2]], failed
+                    ), 2
+                )
+                register, = Register.search([])
+                self.assertEqual(register.transaction_id, 'T1')
+                self.assertEqual(register.status, 'complete')
+                self.assertEqual(len(register.logs), 3)
+            finally:
+                del COD.parse_notification
+                gateway._capabilities.clear()
+                shutil.rmtree(CONFIG['data_path'])
+                CONFIG['data_path'] = data_path
+
+    def test_0195_webhook_csrf_exemption(self):
+        "Only the applications of the module must exempt the webhook route"
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            apps = [self.get_app(), self.get_app()]
+            for app in apps:
+                app.config['WTF_CSRF_ENABLED'] = True
+                with app.test_client() as c:
+                    # Not refused by the CSRF protection, COD does not
+                    # accept notifications
+                    rv = c.post(
+                        '/_payment_webhook/nereid.payment.cod', data='{}'
+                    )
+                    self.assertEqual(rv.status_code, 404)
+                    rv = c.post('/cart/add', data={
+                        'product': self.product1.id, 'quantity': 1
+                    })
+                    self.assertEqual(rv.status_code, 400)
+            self.assertTrue(all(gateway._csrf_exempted[app] for app in apps))
+
+            # An application of a database without the module
+            other_app = self.get_app()
+            other_app.config['DATABASE_NAME'] = 'without_nereid_payment'
+            gateway.exempt_webhook_from_csrf(other_app)
+            self.assertFalse(gateway._csrf_exempted[other_app])
+            self.assertFalse(
+                'protect' in other_app.csrf_protection.__dict__
+            )
+
+    def test_0200_async_payment_job(self):
+        "Asynchronous payment jobs must be claimed and run once"
+        Register = POOL.get('nereid.payment.register')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            app.config['PAYMENT_JOB_QUEUE'] = ImmediateJobQueue()
+            _, cod, (sale1, sale2) = self._setup_cod_sales(
+                2, asynchronous=True
+            )
+
+            with app.test_request_context('/'):
+                self.assertTrue(self.Payment.process(sale1, cod.id))
+            register, = Register.search([('sale', '=', sale1.id)])
+            self.assertEqual(register.status, 'complete')
+            self.assertEqual(register.action, 'capture')
+            self.assertTrue(register.job_claimed_at)
+            self.assertEqual(
+                register.logs[-1].message, 'Payment job capture succeeded'
+            )
+
+            # The checkout polls the status of the payment of the sale
+            with app.test_client() as c:
+                self.login(c, 'email@example.com', 'password')
+                rv = c.get('/_payment_status/%d' % sale1.id)
+                self.assertEqual(json.loads(rv.data), {
+                    'register': register.id, 'status': 'complete',
+                })
+                rv = c.get('/_payment_status/%d' % sale2.id)
+                self.assertEqual(rv.status_code, 404)
+
+            # A job claimed by another worker is not run again
+            with app.test_request_context('/'):
+                register, = Register.create([
+                    self.Payment._get_register_values(sale2, cod, None)
+                ])
+            Register.write([register], {
+                'gateway': cod.id,
+                'action': 'capture',
+            })
+            self.assertTrue(Register.claim_job(register))
+            self.assertFalse(Register.claim_job(register))
+            self.Payment.run_payment_job(Register(register.id))
+            self.assertEqual(Register(register.id).status, 'in-progress')
+
+    def test_0210_idempotent_process(self):
+        "Repeated submissions must get the result of the original attempt"
+        Register = POOL.get('nereid.payment.register')
+        COD = POOL.get('nereid.payment.cod')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            app = self.get_app()
+            _, cod, (sale1, sale2) = self._setup_cod_sales(2)
+
+            with app.test_request_context('/'):
+                self.assertTrue(self.Payment.process(sale1, cod.id, 'K1'))
+                self.assertTrue(self.Payment.process(sale1, cod.id, 'K1'))
+            register, = Register.search([('sale', '=', sale1.id)])
+            self.assertEqual(register.status, 'complete')
+
+            # A duplicate which lost the race on the unique constraint is
+            # refused
+            with app.test_request_context('/'):
+                self.assertRaises(
+                    Conflict, self.Payment._create_idempotent_register,
+                    sale1, cod, 'K1'
+                )
+
+            # A redirect to the provider is recorded and sent again
+            COD.capture = classmethod(
+                lambda cls, sale: redirect('http://provider.test/pay/1')
+            )
+            try:
+                with app.test_request_context('/'):
+                    rv = self.Payment.process(sale2, cod.id, 'K2')
+                    self.assertEqual(rv.status_code, 302)
+                    rv = self.Payment.process(sale2, cod.id, 'K2')
+                    self.assertEqual(rv.status_code, 302)
+                    self.assertEqual(
+                        rv.location, 'http://provider.test/pay/1'
+                    )
+            finally:
+                del COD.capture
+            register, = Register.search([('sale', '=', sale2.id)])
+            self.assertEqual(register.status, 'in-progress')
+            self.assertEqual(register.process_status, 'redirected')
+
+            # An attempt still in progress without a redirect is refused
+            Register.write([register], {'redirect_url': None})
+            with app.test_request_context('/'):
+                self.assertRaises(
+                    Conflict, self.Payment.process, sale2, cod.id, 'K2'
+                )
+
+    def test_0220_translations_cache(self):
+        "Catalogues must be loaded once per language unless they change"
+        def write_catalogue(translation):
+            catalog = Catalog(locale='fr_FR')
+            catalog.add(u'Yes', translation)
+            directory = os.path.join(i18n_dir, 'fr_FR', 'LC_MESSAGES')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'messages.mo')
+            with open(path, 'wb') as fileobj:
+                write_mo(fileobj, catalog)
+            return path
+
+        i18n_dir = tempfile.mkdtemp()
+        original_dir = i18n.I18N_DIR
+        i18n.I18N_DIR = i18n_dir
+        try:
+            path = write_catalogue(u'Oui')
+            self.assertEqual(i18n.get_languages(), ['fr_FR'])
+            i18n.preload_translations()
+            translations = i18n._translations['fr_FR']
+
+            with Transaction().start(DB_NAME, USER, CONTEXT):
+                with Transaction().set_context(language='fr_FR'):
+                    self.assertEqual(i18n.gettext(u'Yes'), u'Oui')
+                    self.assertTrue(i18n.get_translations() is translations)
+
+                    # A changed catalogue is only reloaded when asked to
+                    write_catalogue(u'Oui !')
+                    mtime = os.path.getmtime(path) + 10
+                    os.utime(path, (mtime, mtime))
+                    self.assertEqual(i18n.gettext(u'Yes'), u'Oui')
+                    i18n.reload_on_change = True
+                    try:
+                        self.assertEqual(i18n.gettext(u'Yes'), u'Oui !')
+                    finally:
+                        i18n.reload_on_change = False
+        finally:
+            i18n.I18N_DIR = original_dir
+            i18n._translations.pop('fr_FR', None)
+            i18n._mtimes.pop('fr_FR', None)
+            shutil.rmtree(i18n_dir)
+
 
 def suite():
     "Payment test suite"
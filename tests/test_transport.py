@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+'''
+
+    Test the transport to payment providers against a local stub server
+
+    :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Ltd.
+    :license: GPLv3, see LICENSE for more details
+'''
+import time
+import unittest
+import threading
+import BaseHTTPServer
+import SocketServer
+
+from trytond.modules.nereid_payment.transport import (
+    ProviderTransport, TransportError, get_transport, close_transports,
+)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Provider stub which answers the statuses queued in `statuses`, 200
+    once they are exhausted, and records the requests it gets
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), StubHandler
+        )
+        self.statuses = []
+        self.delay = 0
+        self.close_idle = False
+        self.drop_posts = False
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # The client closes the connections of the requests it timed out
+        pass
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_request(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            status = server.statuses.pop(0) if server.statuses else 200
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            self.rfile.read(length)
+            if server.drop_posts and self.command == 'POST':
+                # Close the connection once the request is received,
+                # without answering it
+                self.close_connection = True
+                return
+            time.sleep(server.delay)
+
+            body = '{"status": %d}' % status
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            # Close the keep-alive connection without telling the client,
+            # like a provider dropping idle connections
+            self.close_connection = server.close_idle
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    do_GET = do_POST = handle_request
+
+
+class TestTransport(unittest.TestCase):
+    "Test the pooled transport to payment providers"
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        close_transports()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_transport(self, **options):
+        options.setdefault('backoff', 0)
+        return ProviderTransport(
+            'stub', '127.0.0.1', self.server.server_address[1],
+            secure=False, **options
+        )
+
+    def test_0010_keep_alive(self):
+        "Sequential requests must reuse the same connection"
+        transport = self.get_transport()
+
+        for index in xrange(5):
+            response = transport.request('GET', '/charges/%d' % index)
+            self.assertEqual(response.status, 200)
+            self.assertEqual(response.body, '{"status": 200}')
+
+        self.assertEqual(transport.stats['requests'], 5)
+        self.assertEqual(transport.stats['connections'], 1)
+
+    def test_0020_retry(self):
+        "Idempotent requests must be retried on errors of the provider"
+        transport = self.get_transport(retries=2)
+        self.server.statuses = [503, 502]
+
+        response = transport.request('GET', '/charges/1')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(transport.stats['retries'], 2)
+
+        # The last response is returned once the retries are exhausted
+        self.server.statuses = [503, 503, 503]
+        response = transport.request('GET', '/charges/1')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(transport.stats['failures'], 1)
+
+    def test_0030_no_retry_of_post(self):
+        "POST requests must only be retried when they are idempotent"
+        transport = self.get_transport(retries=2)
+
+        self.server.statuses = [503]
+        response = transport.request('POST', '/charges', '{}')
+        self.assertEqual(response.status, 503)
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.server.statuses = [503]
+        response = transport.request(
+            'POST', '/charges', '{}', {'Idempotency-Key': 'K1'},
+            idempotent=True
+        )
+        self.assertEqual(response.status, 200)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_0040_timeout(self):
+        "A provider slower than the timeout must raise a TransportError"
+        transport = self.get_transport(timeout=0.2, retries=1)
+        self.server.delay = 0.5
+
+        self.assertRaises(TransportError, transport.request, 'GET', '/slow')
+        self.assertEqual(transport.stats['retries'], 1)
+        self.assertEqual(transport.stats['failures'], 1)
+
+    def test_0045_no_resend_after_timeout(self):
+        "A request which timed out must not be sent again on a new connection"
+        transport = self.get_transport(timeout=0.2, retries=2)
+        transport.request('GET', '/charges')
+
+        self.server.delay = 0.5
+        self.assertRaises(
+            TransportError, transport.request, 'POST', '/slow', '{}'
+        )
+        self.assertEqual(self.server.requests.count(('POST', '/slow')), 1)
+
+    def test_0046_stale_connection(self):
+        "A connection closed by the provider while idle must be replaced"
+        transport = self.get_transport(retries=0)
+        self.server.close_idle = True
+
+        transport.request('GET', '/charges')
+        time.sleep(0.05)
+        response = transport.request('POST', '/charges', '{}')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(self.server.requests.count(('POST', '/charges')), 1)
+        self.assertEqual(transport.stats['connections'], 2)
+
+    def test_0047_no_resend_after_drop(self):
+        "A POST the provider received must not be sent again"
+        transport = self.get_transport(retries=0)
+        self.server.drop_posts = True
+
+        transport.request('GET', '/charges')
+        self.assertRaises(
+            TransportError, transport.request, 'POST', '/charges', '{}'
+        )
+        self.assertEqual(self.server.requests.count(('POST', '/charges')), 1)
+
+        # An idempotent request is sent again on a new connection
+        transport.request('GET', '/charges')
+        self.assertRaises(
+            TransportError, transport.request, 'POST', '/charges', '{}',
+            idempotent=True
+        )
+        self.assertEqual(self.server.requests.count(('POST', '/charges')), 3)
+
+    def test_0050_bounded_concurrency(self):
+        "The requests in flight must not exceed the size of the pool"
+        transport = self.get_transport(pool_size=2)
+        self.server.delay = 0.05
+
+        threads = [
+            threading.Thread(
+                target=transport.request, args=('GET', '/charges')
+            ) for index in xrange(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.server.requests), 8)
+        self.assertTrue(self.server.max_active <= 2)
+        self.assertTrue(transport.stats['connections'] <= 2)
+
+    def test_0060_shared_transport(self):
+        "The transport of a provider must be shared in the worker"
+        transport = get_transport(
+            'stub', '127.0.0.1', port=self.server.server_address[1],
+            secure=False
+        )
+        self.assertTrue(get_transport('stub', '127.0.0.1') is transport)
+        self.assertEqual(transport.request('GET', '/').status, 200)
+
+
+def suite():
+    "Transport test suite"
+    suite = unittest.TestSuite()
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestTransport)
+    )
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
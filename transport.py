@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+    transport
+
+    A shared HTTP transport for the gateway models which call payment
+    providers from `capture` and `authorize`.
+
+    Each provider gets a pool of keep-alive connections per worker, so the
+    TCP and TLS handshakes are paid once per connection instead of once per
+    payment, and the number of requests in flight to a provider is bounded
+    by the size of its pool. Requests have a timeout, failures are retried
+    with an exponential backoff and the latency of every request is recorded
+    in the metrics of :mod:`instrumentation`.
+
+    A gateway model gets the transport of its provider with::
+
+        transport = get_transport('acme', 'api.acme.com')
+        response = transport.request(
+            'POST', '/v1/charges', body, headers, idempotent=True
+        )
+
+    :copyright: © 2013 by Openlabs Technologies & Consulting (P) Limited
+    :license: GPLv3, see LICENSE for more details.
+"""
+import time
+import errno
+import select
+import socket
+import logging
+import httplib
+import threading
+
+from instrumentation import record_provider_request
+
+__all__ = [
+    'TransportError', 'Response', 'ProviderTransport', 'get_transport',
+    'close_transports',
+]
+
+logger = logging.getLogger('nereid.payment.transport')
+
+#: Methods which are safe to retry without an idempotency key
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+
+class TransportError(Exception):
+    "Raised when a request to a provider fails after all its attempts"
+
+
+class Response(object):
+    "The response of a provider, read in full"
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return '<Response %d %s>' % (self.status, self.reason)
+
+
+class ProviderTransport(object):
+    """Pool of keep-alive connections to the host of a provider.
+
+    :param name: Name of the provider, used in the logs and metrics
+    :param host: Host name of the provider
+    :param port: Port, the default port of the scheme if None
+    :param secure: Use HTTPS
+    :param pool_size: Maximum number of connections, which is also the
+                      maximum number of requests in flight
+    :param timeout: Timeout in seconds of the socket operations
+    :param retries: Number of times a failed request is retried
+    :param backoff: Delay in seconds before the first retry, doubled on each
+                    following retry
+    :param retry_statuses: Statuses of responses which are retried
+    """
+
+    def __init__(self, name, host, port=None, secure=True, pool_size=4,
+            timeout=10, retries=2, backoff=0.1,
+            retry_statuses=(502, 503, 504)):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_statuses = frozenset(retry_statuses)
+
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'failures': 0,
+            'connections': 0,
+            'time': 0.0,
+        }
+
+    def _connect(self):
+        "Open a new connection to the provider"
+        if self.secure:
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        with self.lock:
+            self.stats['connections'] += 1
+        return connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _get_connection(self):
+        """Return an idle connection of the pool and whether it was used
+        before, or a new connection if none is idle. The idle connections
+        the provider closed are dropped.
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection = self.idle.pop()
+            if not _is_dropped(connection):
+                return connection, True
+            connection.close()
+        return self._connect(), False
+
+    def _release(self, connection):
+        "Put the connection back in the pool"
+        with self.lock:
+            self.idle.append(connection)
+
+    def _send(self, method, path, body, headers, idempotent):
+        """Send the request on a connection of the pool and return its
+        response. If a reused connection turns out to be closed by the
+        provider, the request is sent again on a new connection when it was
+        not written yet, or when it is idempotent: otherwise the provider
+        may have received it.
+        """
+        connection, reused = self._get_connection()
+        try:
+            try:
+                sent = False
+                connection.request(method, path, body, headers)
+                sent = True
+                response = connection.getresponse()
+            except (httplib.BadStatusLine, socket.error), exc:
+                if not reused or not _is_stale(exc) or \
+                        (sent and not idempotent):
+                    raise
+                connection.close()
+                connection = self._connect()
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+            rv = Response(
+                response.status, response.reason,
+                dict(response.getheaders()), response.read()
+            )
+        except Exception:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        return rv
+
+    def request(self, method, path, body=None, headers=None,
+            idempotent=None):
+        """Send a request to the provider and return its
+        :class:`Response`.
+
+        Requests which fail with a network error or one of the
+        `retry_statuses` are retried when they are idempotent. POST requests
+        are only idempotent if the caller says so, typically because the
+        provider deduplicates them by an idempotency key.
+
+        :param method: HTTP method
+        :param path: Path of the request, with the query string
+        :param body: Body of the request
+        :param headers: Dictionary of headers
+        :param idempotent: Whether the request can be retried. By default
+                           only the requests of idempotent methods are.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        attempts = 1 + (self.retries if idempotent else 0)
+
+        self.slots.acquire()
+        try:
+            for attempt in xrange(attempts):
+                if attempt:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                    with self.lock:
+                        self.stats['retries'] += 1
+
+                start = time.time()
+                try:
+                    rv = self._send(
+                        method, path, body, headers or {}, idempotent
+                    )
+                except (httplib.HTTPException, socket.error), exc:
+                    rv, error = None, exc
+                latency = time.time() - start
+
+                with self.lock:
+                    self.stats['requests'] += 1
+                    self.stats['time'] += latency
+                record_provider_request(
+                    self.name, rv and rv.status, latency
+                )
+
+                if rv is not None and rv.status not in self.retry_statuses:
+                    return rv
+                if rv is not None:
+                    error = 'status %d' % rv.status
+                logger.warning(
+                    '%s %s to %s failed (attempt %d of %d): %s' % (
+                        method, path, self.name, attempt + 1, attempts, error
+                    )
+                )
+        finally:
+            self.slots.release()
+
+        with self.lock:
+            self.stats['failures'] += 1
+        if rv is not None:
+            # The provider answered, the caller decides what to do of it
+            return rv
+        raise TransportError(
+            '%s %s to %s failed: %s' % (method, path, self.name, error)
+        )
+
+    def close(self):
+        "Close the idle connections of the pool"
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+def _is_stale(exc):
+    """Return True if the error shows that the provider closed the
+    connection. A timeout never does: the provider may be processing the
+    request.
+
+    :param exc: The error of the request
+    """
+    if isinstance(exc, socket.timeout):
+        return False
+    if isinstance(exc, httplib.BadStatusLine):
+        # The connection was closed without an answer
+        return True
+    return getattr(exc, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+def _is_dropped(connection):
+    """Return True if the provider closed the idle connection. An idle
+    connection has nothing to read, so a readable one was closed or is
+    out of sync with the provider.
+    """
+    if connection.sock is None:
+        # Connected again on the next request
+        return False
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(name, host, **options):
+    """Return the transport of the provider in this worker, creating it with
+    the given options the first time.
+
+    :param name: Name of the provider
+    :param host: Host name of the provider
+    :param options: Keyword arguments of :class:`ProviderTransport`
+    """
+    with _transports_lock:
+        transport = _transports.get(name)
+        if transport is None:
+            transport = _transports[name] = ProviderTransport(
+                name, host, **options
+            )
+        return transport
+
+
+def close_transports():
+    "Close the idle connections of all the transports and forget them"
+    with _transports_lock:
+        transports = _transports.values()
+        _transports.clear()
+    for transport in transports:
+        transport.close()